@@ -1,15 +1,23 @@
 import asyncio
 import os
 import json
+import orjson
 import logging
+import random
+import time
 import urllib.parse
+try:
+    # libuv-based event loop: cheaper socket reads on the SSE streams; the stdlib loop is used without it
+    import uvloop
+except ImportError:
+    uvloop = None
 from dotenv import load_dotenv
 from anyio import ClosedResourceError
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langchain.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from langchain.agents import create_tool_calling_agent, AgentExecutor
-from langchain.tools import Tool
+from langchain.tools import StructuredTool, Tool
 from langchain_community.callbacks import get_openai_callback
 from langchain_groq import ChatGroq
 
@@ -26,53 +34,84 @@ params = {
 }
 query_string = urllib.parse.urlencode(params)
 MCP_SERVER_URL = f"{base_url}?{query_string}"
+# Step-by-step agent traces on stdout; off by default since they are written synchronously on every step
+VERBOSE = bool(int(os.getenv("AGENT_VERBOSE", "0")))
+PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts", "interface.md")
 AGENT_NAME = "user_interaction_agent"
 
+# Static rules go first and stay byte-identical across calls so OpenAI's prompt cache can reuse the prefix
+with open(PROMPT_PATH, encoding="utf-8") as f:
+    SYSTEM_PROMPT = f.read()
+
+AGENT_LIST_TTL = 300  # seconds
+
+# list_agents results keyed by call arguments, kept for the process lifetime
+_agent_cache = {}
+
+# Escapes braces in one pass so tool schemas survive ChatPromptTemplate formatting
+BRACE_ESCAPE = str.maketrans({"{": "{{", "}": "}}"})
+
+# Tool name -> compact, brace-escaped JSON schema
+_tool_schemas = {}
+
+# Sorted tool names -> AgentExecutor, reused across reconnects
+_executor_cache = {}
+
+def strip_titles(schema):
+    if isinstance(schema, dict):
+        return {k: strip_titles(v) for k, v in schema.items() if not (k == "title" and isinstance(v, str))}
+    if isinstance(schema, list):
+        return [strip_titles(v) for v in schema]
+    return schema
+
+def get_tool_schema(tool):
+    # Memoized by tool name: schemas do not change across reconnects
+    if tool.name not in _tool_schemas:
+        _tool_schemas[tool.name] = orjson.dumps(strip_titles(tool.args)).decode().translate(BRACE_ESCAPE)
+    return _tool_schemas[tool.name]
+
 def get_tools_description(tools):
-    return "\n".join(
-        f"Tool: {tool.name}, Schema: {json.dumps(tool.args).replace('{', '{{').replace('}', '}}')}"
-        for tool in tools
-    )
+    return "\n".join(f"Tool: {tool.name}, Schema: {get_tool_schema(tool)}" for tool in tools)
+
+def cache_list_agents(tools):
+    """Wrap the Coral `list_agents` tool so repeated calls within AGENT_LIST_TTL reuse the previous result."""
+    def wrap(list_agents):
+        async def list_agents_cached(**kwargs):
+            key = json.dumps(kwargs, sort_keys=True)
+            ts, agents = _agent_cache.get(key, (0, None))
+            if time.time() - ts >= AGENT_LIST_TTL:
+                agents = await list_agents.ainvoke(kwargs)
+                _agent_cache[key] = (time.time(), agents)
+            return agents
+
+        return StructuredTool(
+            name=list_agents.name,
+            description=list_agents.description,
+            args_schema=list_agents.args_schema,
+            coroutine=list_agents_cached
+        )
+
+    return [wrap(tool) if tool.name == "list_agents" else tool for tool in tools]
 
 async def ask_human_tool(question: str) -> str:
     print(f"Agent asks: {question}")
-    return input("Your response: ")
+    # Read stdin off the event loop so other agents sharing the loop (see main_all.py) keep running
+    return await asyncio.to_thread(input, "Your response: ")
 
-async def create_interface_agent(client, tools):
-    tools_description = get_tools_description(tools)
-    
+async def create_interface_agent(client, tools, tools_description):
     prompt = ChatPromptTemplate.from_messages([
-        (
-            "system",
-            f"""You are an agent interacting with the tools from Coral Server and using your own `ask_human` tool to communicate with the user.
-
-            Follow these steps in order:
-
-            1. Use `list_agents` to list all connected agents and get their descriptions.
-            2. Use `ask_human` to ask: "How can I assist you today?" and wait for the response.
-            3. Take 2 seconds to understand the user's intent and decide which agent(s) are needed based on their descriptions.
-            4. If the user requests Coral Server information (e.g., agent status, connection info), use your tools to retrieve and return the information directly to the user, then go back to Step 1.
-            5. If fulfilling the request requires multiple agents, determine the sequence and logic for calling them.
-            6. For each selected agent:
-            * **If a conversation thread with the agent does not exist, use `create_thread` to create one.**
-            * Construct a clear instruction message for the agent.
-            * Use **`send_message(senderId=..., mentions=[Receive Agent Id], threadId=..., content="instruction")`.**
-            * Use `wait_for_mentions(timeoutMs=60000)` to receive the agent's response, 
-              if there is no meesage receive during the first time, check if you mention the receiver ID when you use `send_message(senderId=..., mentions=[Receive Agent Id], threadId=..., content="instruction")`,
-              otherwise, recall `wait_for_mentions(timeoutMs=60000)` up to 5 times if no message received.
-            * Record and store the response for final presentation.
-            7. After all required agents have responded, show the complete conversation (all thread messages) to the user.
-            8. Wait for 3 seconds, then use `ask_human` to ask: "Is there anything else I can help you with?"
-            9. If the user replies with a new request, repeat the process from Step 1.
-            - Use only tools: {tools_description}"""),
+        ("system", SYSTEM_PROMPT),
+        ("system", f"Use only tools: {tools_description}"),
         ("placeholder", "{agent_scratchpad}")
     ])
 
     model = ChatOpenAI(
         model="gpt-4.1-mini-2025-04-14",
         api_key=os.getenv("OPENAI_API_KEY"),
-        temperature=0.3,
-        max_tokens=32768
+        temperature=0,
+        streaming=True,
+        stream_usage=True,
+        max_tokens=4096
     )
 
     '''model = ChatGroq(
@@ -81,59 +120,106 @@ async def create_interface_agent(client, tools):
     )'''
 
     agent = create_tool_calling_agent(model, tools, prompt)
-    return AgentExecutor(agent=agent, tools=tools, max_iterations=100 ,verbose=True, stream_runnable=False)
+    return AgentExecutor(agent=agent, tools=tools, max_iterations=100, verbose=VERBOSE, stream_runnable=True)
+
+async def get_agent_executor(client, tools, tools_description):
+    # A reconnect yields the same tools bound to a new session: keep the executor (prompt, model,
+    # tool schemas already bound to it) and only swap in the new tool objects
+    key = tuple(sorted(tool.name for tool in tools))
+    agent_executor = _executor_cache.get(key)
+    if agent_executor is None:
+        agent_executor = _executor_cache[key] = await create_interface_agent(client, tools, tools_description)
+    else:
+        agent_executor.tools = tools
+    return agent_executor
+
+async def connect_client():
+    client = MultiServerMCPClient(
+        connections={
+            "coral": {
+                "transport": "sse",
+                "url": MCP_SERVER_URL,
+                "timeout": 600,
+                "sse_read_timeout": 600,
+            }
+        }
+    )
+    await client.__aenter__()
+    logger.info(f"Connected to MCP server at {MCP_SERVER_URL}")
+    return client
+
+async def disconnect_client(client):
+    if client is not None:
+        try:
+            await client.__aexit__(None, None, None)
+        except Exception as e:
+            logger.warning(f"Error while closing MCP client: {e}")
+    return None
+
+RETRY_BASE_DELAY = 1.0  # seconds
+RETRY_MAX_DELAY = 60.0  # seconds
+
+async def backoff(attempt):
+    # Exponential backoff with full jitter, so agents that fail together do not reconnect in lockstep
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    logger.info(f"Retrying in {delay:.1f} seconds...")
+    await asyncio.sleep(delay)
 
 async def main():
     max_retries = 5
-    retry_delay = 5  # seconds
-    for attempt in range(max_retries):
-        try:
-            async with MultiServerMCPClient(
-                connections={
-                    "coral": {
-                        "transport": "sse",
-                        "url": MCP_SERVER_URL,
-                        "timeout": 600,
-                        "sse_read_timeout": 600,
-                    }
-                }
-            ) as client:
-                logger.info(f"Connected to MCP server at {MCP_SERVER_URL}")
-                tools = client.get_tools() + [Tool(
-                    name="ask_human",
-                    func=None,
-                    coroutine=ask_human_tool,
-                    description="Ask the user a question and wait for a response."
-                )]
-                logger.info(f"Tools Description:\n{get_tools_description(tools)}")
+    client = None
+    agent_executor = None
+    try:
+        for attempt in range(max_retries):
+            try:
+                if agent_executor is None:
+                    client = await connect_client()
+                    tools = cache_list_agents(client.get_tools()) + [Tool(
+                        name="ask_human",
+                        func=None,
+                        coroutine=ask_human_tool,
+                        description="Ask the user a question and wait for a response."
+                    )]
+                    # Sorted so the tool list, and with it the prompt prefix, is identical across sessions
+                    tools.sort(key=lambda tool: tool.name)
+                    tools_description = get_tools_description(tools)
+                    logger.info(f"Tools Description:\n{tools_description}")
+                    agent_executor = await get_agent_executor(client, tools, tools_description)
 
                 with get_openai_callback() as cb:
-                    agent_executor = await create_interface_agent(client, tools)
                     await agent_executor.ainvoke({})
                     logger.info(f"Token usage for this run:")
                     logger.info(f"  Prompt Tokens: {cb.prompt_tokens}")
                     logger.info(f"  Completion Tokens: {cb.completion_tokens}")
                     logger.info(f"  Total Tokens: {cb.total_tokens}")
                     logger.info(f"  Total Cost (USD): ${cb.total_cost:.6f}")
-        except ClosedResourceError as e:
-            logger.error(f"ClosedResourceError on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                logger.error("Max retries reached. Exiting.")
-                raise
-        except Exception as e:
-            logger.error(f"Unexpected error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                logger.error("Max retries reached. Exiting.")
-                raise
+            except ClosedResourceError as e:
+                logger.error(f"ClosedResourceError on attempt {attempt + 1}: {e}")
+                # The SSE connection is gone, so the next attempt has to reconnect
+                client, agent_executor = await disconnect_client(client), None
+                if attempt < max_retries - 1:
+                    await backoff(attempt)
+                    continue
+                else:
+                    logger.error("Max retries reached. Exiting.")
+                    raise
+            except Exception as e:
+                logger.error(f"Unexpected error on attempt {attempt + 1}: {e}")
+                if agent_executor is None:
+                    # Failed while connecting; start over with a fresh client
+                    client = await disconnect_client(client)
+                if attempt < max_retries - 1:
+                    await backoff(attempt)
+                    continue
+                else:
+                    logger.error("Max retries reached. Exiting.")
+                    raise
+    finally:
+        await disconnect_client(client)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
 
@@ -1,14 +1,23 @@
 import os
-import json
+import orjson
 import logging
+import random
+import re
 import subprocess
-import traceback
 import asyncio
+import concurrent.futures
 import urllib.parse
+try:
+    # libuv-based event loop: cheaper socket reads on the SSE streams; the stdlib loop is used without it
+    import uvloop
+except ImportError:
+    uvloop = None
 from dotenv import load_dotenv
+from typing import Any, Type
+from pydantic import BaseModel
 
 from crewai import Agent, Task, Crew, LLM
-from crewai.tools import tool
+from crewai.tools import BaseTool, tool
 from crewai_tools import MCPServerAdapter
 
 # Setup logging with more detailed format
@@ -20,7 +29,8 @@ logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
-print("Environment variables loaded")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.debug("Environment variables loaded")
 
 # MCP Server configuration
 base_url = "http://localhost:5555/devmode/exampleApplication/privkey/session1/sse"
@@ -34,87 +44,162 @@ params = {
 }
 query_string = urllib.parse.urlencode(params)
 MCP_SERVER_URL = f"{base_url}?{query_string}"
-print(f"MCP Server URL: {MCP_SERVER_URL}")
+# Step-by-step agent traces on stdout; off by default since they are written synchronously on every step
+VERBOSE = bool(int(os.getenv("AGENT_VERBOSE", "0")))
+logger.debug(f"MCP Server URL: {MCP_SERVER_URL}")
+
+# Deterministic parsing of checkout requests, e.g. "Checkout PR #42 from 'octocat/calculator'"
+PR_RE = re.compile(r"\b(?:PR|pull request)\s*(?:#|number\s*)?'?(\d+)\b|'(\d+)'\s*PR\b", re.IGNORECASE)
+REPO_RE = re.compile(r"(?<![\w./:-])([A-Za-z0-9][\w-]*/[\w.-]*\w)(?![\w/])")
+AUTO_DISPATCH_MARKER = "[Auto-dispatched]"
+
+# Escapes braces in one pass so tool schemas survive prompt template formatting
+BRACE_ESCAPE = str.maketrans({"{": "{{", "}": "}}"})
 
 # Validate API keys
 if not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY is not set in environment variables.")
 else:
-    print("OpenAI API key found")
+    logger.debug("OpenAI API key found")
 
-@tool("Checkout GitHub PR")
-def checkout_github_pr(repo_full_name: str, pr_number: int) -> str:
+async def run_git(*args: str) -> str:
     """
-    Clone a GitHub repository and check out the branch associated with a specific pull request.
+    Run a git command asynchronously and return its stdout.
 
-    Args:
-        repo_full_name (str): GitHub repository in the format "owner/repo".
-        pr_number (int): Pull request number.
-
-    Returns:
-        str: Absolute path to the local repository checked out to the PR branch.
+    Raises:
+        subprocess.CalledProcessError: If git exits with a non-zero status.
     """
-    print(f"Tool called: checkout_github_pr({repo_full_name}, {pr_number})")
+    proc = await asyncio.create_subprocess_exec(
+        'git', *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, ['git', *args], stdout.decode(), stderr.decode())
+    return stdout.decode()
+
+async def checkout_github_pr_async(repo_full_name: str, pr_number: int) -> str:
+    logger.debug(f"Tool called: checkout_github_pr({repo_full_name}, {pr_number})")
     dest_dir = os.getcwd()
-    print(f"Working directory: {dest_dir}")
+    logger.debug(f"Working directory: {dest_dir}")
 
     repo_name = repo_full_name.split('/')[-1]
     repo_url = f'https://github.com/{repo_full_name}.git'
     repo_path = os.path.join(dest_dir, repo_name)
     pr_branch = f'pr-{pr_number}'
+    # Fetch into a remote-tracking ref so the fetch never collides with the checked-out branch
+    pr_ref = f'refs/remotes/origin/{pr_branch}'
+    worktree_path = f'{repo_path}-pr{pr_number}'
     
-    print(f"Repository URL: {repo_url}")
-    print(f"Local path: {repo_path}")
-    print(f"PR branch: {pr_branch}")
+    logger.debug(f"Repository URL: {repo_url}")
+    logger.debug(f"Local path: {repo_path}")
+    logger.debug(f"PR branch: {pr_branch}")
 
     try:
         if not os.path.exists(repo_path):
-            print(f"Cloning repository {repo_url} to {repo_path}")
-            subprocess.run(['git', 'clone', repo_url, repo_path], check=True)
-            print("Clone completed successfully")
+            logger.debug(f"Cloning repository {repo_url} to {repo_path}")
+            # Shallow partial clone: only the tip commit, blobs fetched lazily on checkout
+            await run_git('clone', '--filter=blob:none', '--no-checkout', '--depth=1', repo_url, repo_path)
+            logger.debug("Clone completed successfully")
+
+            logger.debug(f"Fetching PR #{pr_number}")
+            await run_git('-C', repo_path, 'fetch', '--depth=1', 'origin', f'+pull/{pr_number}/head:{pr_ref}')
+            logger.debug(f"Checking out PR branch: {pr_branch}")
+            await run_git('-C', repo_path, 'checkout', '-B', pr_branch, pr_ref)
+            result_path = os.path.abspath(repo_path)
         else:
-            print(f"Repository already exists at {repo_path}")
+            # Leave the existing checkout alone and give the PR its own worktree sharing the same object store
+            logger.debug(f"Repository already exists at {repo_path}, using worktree {worktree_path}")
+            logger.debug(f"Fetching PR #{pr_number} and pruning stale worktrees")
+            await asyncio.gather(
+                run_git('-C', repo_path, 'fetch', '--depth=1', 'origin', f'+pull/{pr_number}/head:{pr_ref}'),
+                run_git('-C', repo_path, 'worktree', 'prune')
+            )
 
-        try:
-            print("Attempting to checkout main branch")
-            subprocess.run(['git', '-C', repo_path, 'checkout', 'main'], check=True)
-            print("Checked out main branch")
-        except subprocess.CalledProcessError:
-            try:
-                print("Main branch not found, attempting to checkout master branch")
-                subprocess.run(['git', '-C', repo_path, 'checkout', 'master'], check=True)
-                print("Checked out master branch")
-            except subprocess.CalledProcessError:
-                print("Neither main nor master branch found, continuing with current branch")
-                pass
-
-        print("Checking existing branches")
-        existing_branches = subprocess.run(['git', '-C', repo_path, 'branch'], capture_output=True, text=True).stdout
-        print(f"Existing branches: {existing_branches}")
-        
-        if pr_branch in existing_branches:
-            print(f"Deleting existing PR branch: {pr_branch}")
-            subprocess.run(['git', '-C', repo_path, 'branch', '-D', pr_branch], check=True)
-
-        print(f"Fetching PR #{pr_number}")
-        subprocess.run(['git', '-C', repo_path, 'fetch', 'origin', f'pull/{pr_number}/head:{pr_branch}'], check=True)
-        print(f"Checking out PR branch: {pr_branch}")
-        subprocess.run(['git', '-C', repo_path, 'checkout', pr_branch], check=True)
-        
-        result_path = os.path.abspath(repo_path)
-        print(f"Successfully checked out PR. Repository path: {result_path}")
+            # Detached, since the pr-<n> branch may already be checked out in the main worktree
+            if os.path.exists(worktree_path):
+                logger.debug(f"Updating existing worktree {worktree_path}")
+                await run_git('-C', worktree_path, 'checkout', '--detach', pr_ref)
+            else:
+                logger.debug(f"Adding worktree {worktree_path}")
+                await run_git('-C', repo_path, 'worktree', 'add', '-f', '--detach', worktree_path, pr_ref)
+            result_path = os.path.abspath(worktree_path)
+
+        logger.debug(f"Successfully checked out PR. Repository path: {result_path}")
         return result_path
     
     except subprocess.CalledProcessError as e:
         error_message = f"Git operation failed: {e.stderr if hasattr(e, 'stderr') else str(e)}"
-        print(f"ERROR: {error_message}")
+        logger.error(error_message)
         return f"Error: {error_message}"
     except Exception as e:
         error_message = f"Unexpected error: {str(e)}"
-        print(f"ERROR: {error_message}")
-        traceback.print_exc()
+        logger.error(error_message, exc_info=True)
         return f"Error: {error_message}"
-        
+
+@tool("Checkout GitHub PR")
+def checkout_github_pr(repo_full_name: str, pr_number: int) -> str:
+    """
+    Clone a GitHub repository and check out the branch associated with a specific pull request.
+
+    Args:
+        repo_full_name (str): GitHub repository in the format "owner/repo".
+        pr_number (int): Pull request number.
+
+    Returns:
+        str: Absolute path to the local checkout of the PR. The first checkout of a repository uses
+            the clone itself; later ones get their own worktree at "<repo>-pr<pr_number>".
+    """
+    return run_checkout(repo_full_name, pr_number)
+
+def run_checkout(repo_full_name: str, pr_number: int) -> str:
+    coro = checkout_github_pr_async(repo_full_name, pr_number)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # CrewAI calls tools synchronously from inside main()'s event loop, so run on a fresh loop in a worker thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+def parse_checkout_request(mentions: str):
+    """
+    Extract a single (repo_full_name, pr_number) checkout request from wait_for_mentions output.
+
+    Returns:
+        tuple | None: The request, or None when no unambiguous repo and PR number are present.
+    """
+    repos = set(REPO_RE.findall(mentions))
+    pr_numbers = {a or b for a, b in PR_RE.findall(mentions)}
+    if len(repos) != 1 or len(pr_numbers) != 1:
+        return None
+    return repos.pop(), int(pr_numbers.pop())
+
+class AutoCheckoutWaitForMentions(BaseTool):
+    """
+    Wraps the Coral `wait_for_mentions` tool and runs `checkout_github_pr` directly when a mention
+    unambiguously asks for a PR checkout, so the LLM only has to forward the result.
+    """
+    name: str = "wait_for_mentions"
+    description: str = ""
+    args_schema: Type[BaseModel]
+    wait_for_mentions: Any
+
+    def _run(self, **kwargs) -> str:
+        mentions = str(self.wait_for_mentions.run(**kwargs))
+        request = parse_checkout_request(mentions)
+        if request is None:
+            return mentions
+        repo_full_name, pr_number = request
+        logger.info(f"Auto-dispatching checkout of PR #{pr_number} from {repo_full_name}")
+        result = run_checkout(repo_full_name, pr_number)
+        return (
+            f"{mentions}\n\n"
+            f"{AUTO_DISPATCH_MARKER} checkout_github_pr(repo_full_name='{repo_full_name}', pr_number={pr_number}) "
+            f"returned: {result}"
+        )
+
 async def get_tools_description(tools):
     descriptions = []
     for tool in tools:
@@ -122,7 +207,7 @@ async def get_tools_description(tools):
         schema = tool.args_schema.schema() if hasattr(tool, 'args_schema') and tool.args_schema else {}
         arg_names = list(schema.get('properties', {}).keys()) if schema else []
         description = tool.description or 'No description available'
-        schema_str = json.dumps(schema, default=str).replace('{', '{{').replace('}', '}}')
+        schema_str = orjson.dumps(schema, default=str).decode().translate(BRACE_ESCAPE)
         descriptions.append(
             f"Tool: {tool_name}, Schema: {schema_str}"
         )
@@ -144,7 +229,14 @@ async def setup_components():
     # MCP Server
     serverparams = {"url": MCP_SERVER_URL,"timeout": 300, "sse_read_timeout": 300}
     mcp_server_adapter = MCPServerAdapter(serverparams)
-    mcp_tools = mcp_server_adapter.tools
+    mcp_tools = [
+        AutoCheckoutWaitForMentions(
+            description=tool.description,
+            args_schema=tool.args_schema,
+            wait_for_mentions=tool
+        ) if tool.name == "wait_for_mentions" else tool
+        for tool in mcp_server_adapter.tools
+    ]
     agent_tools = mcp_tools + [checkout_github_pr]
 
     # GitClone Agent
@@ -152,7 +244,7 @@ async def setup_components():
         role="Git Clone Agent",
         goal="Clone GitHub repositories and check out branches for specific Pull Requests. Continue running until a PR is successfully checked out.",
         backstory="I am responsible for cloning GitHub repositories and checking out branches associated with specific pull requests. I will not stop until I successfully check out a PR.",
-        verbose=True,
+        verbose=VERBOSE,
         allow_delegation=False,
         llm=llm,
         tools=agent_tools
@@ -160,20 +252,28 @@ async def setup_components():
 
     return gitclone_agent, agent_tools
 
+RETRY_BASE_DELAY = 1.0  # seconds
+RETRY_MAX_DELAY = 60.0  # seconds
+
+async def backoff(attempt):
+    # Exponential backoff with full jitter, so agents that fail together do not reconnect in lockstep
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    logger.info(f"Retrying in {delay:.1f} seconds...")
+    await asyncio.sleep(delay)
+
 async def main():
-    retry_delay = 5
     max_retries = 5
     retries = max_retries
 
-    print("Initializing GitClone system...")
+    logger.info("Initializing GitClone system...")
     gitclone_agent, agent_tools = await setup_components()
     tools_description = await get_tools_description(agent_tools)
-    print(tools_description)
+    logger.debug(f"Tools Description:\n{tools_description}")
 
 
     while True:
         try:
-            print("Creating new task and crew...")
+            logger.debug("Creating new task and crew...")
 
             task = Task(
                 description="""You are `gitclone_agent`, responsible for cloning a GitHub repository and checking out the branch for a specific pull request.
@@ -183,6 +283,7 @@ async def main():
                 3. Check if the message asks to checkout a PR with a given repo name and PR number.
                 4. Extract `repo` and `pr_number` from the message.
                 5. Call `checkout_github_pr(repo_full_name=repo, pr_number=pr_number)` to clone and checkout the PR.
+                   If the `wait_for_mentions` result already contains an "[Auto-dispatched]" line, the checkout has already run: do not call it again, use that line's result.
                 6. If the call is successful, send a message using `send_message` to the sender, saying the PR was checked out with the local path.
                 7. If the call fails, send the error message using `send_message` to the sender.
                 8. If the message format is invalid or incomplete, skip it silently.
@@ -198,25 +299,27 @@ async def main():
             crew = Crew(
                 agents=[gitclone_agent],
                 tasks=[task],
-                verbose=True,
+                verbose=VERBOSE,
                 enable_telemetry=False
             )
 
-            print("Kicking off crew execution")
+            logger.info("Kicking off crew execution")
             result = crew.kickoff()
-            print(f"Crew execution completed with result: {result}")
+            logger.info(f"Crew execution completed with result: {result}")
 
             await asyncio.sleep(1)
 
         except Exception as e:
             retries -= 1
-            print(f"Error: {str(e)}. Retries left: {retries}")
-            logger.error(f"Error in GitClone main loop: {str(e)}", exc_info=True)
+            logger.error(f"Error in GitClone main loop: {str(e)}. Retries left: {retries}", exc_info=True)
             if retries == 0:
-                print("Max retries reached. Exiting.")
+                logger.error("Max retries reached. Exiting.")
                 break
-            await asyncio.sleep(retry_delay)
+            await backoff(max_retries - retries - 1)
 
 if __name__ == "__main__":
-    asyncio.run(main())
-    print("GitClone Agent script completed")
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
+    logger.info("GitClone Agent script completed")
@@ -1,14 +1,21 @@
 import asyncio
 import os
 import json
+import orjson
 import logging
 from camel.toolkits.mcp_toolkit import MCPClient
-from camel.toolkits import MCPToolkit
+from camel.toolkits import FunctionTool, MCPToolkit
 from camel.models import ModelFactory
 from camel.types import ModelPlatformType, ModelType
 from camel.agents import ChatAgent
 import urllib.parse
+try:
+    # libuv-based event loop: cheaper socket reads on the SSE streams; the stdlib loop is used without it
+    import uvloop
+except ImportError:
+    uvloop = None
 from dotenv import load_dotenv
+from get_all_github_files import get_repo
 from langchain_groq import ChatGroq
 
 # Setup logging
@@ -33,6 +40,15 @@ params = {
 }
 query_string = urllib.parse.urlencode(params)
 MCP_SERVER_URL = f"{base_url}?{query_string}"
+PR_FILES_CACHE_SIZE = 128
+GITHUB_MCP_IMAGE = "ghcr.io/github/github-mcp-server"
+
+# Escapes braces in one pass so tool schemas survive prompt template formatting
+BRACE_ESCAPE = str.maketrans({"{": "{{", "}": "}}"})
+
+# (repo full name, PR number, head SHA) -> get_pull_request_files result. A push to the PR moves its
+# head SHA, so an entry never outlives the diff it describes.
+_pr_files_cache = {}
 
 async def connect_client():
     global coral_server, github_client, toolkit
@@ -47,13 +63,18 @@ async def connect_client():
     github_token = os.getenv("GITHUB_ACCESS_TOKEN")
     github_client = MCPClient(
         command_or_url="docker",
+        # One container for the process lifetime: main() enters the toolkit connection once and the agent
+        # loop recovers from step errors inside it. --init reaps the server cleanly when stdin closes, and
+        # host networking skips creating a bridge network for a container that only makes outbound calls.
         args=[
             "run",
             "-i",
             "--rm",
+            "--init",
+            "--network=host",
             "-e",
             "GITHUB_PERSONAL_ACCESS_TOKEN",
-            "ghcr.io/github/github-mcp-server"
+            GITHUB_MCP_IMAGE
         ],
         env={"GITHUB_PERSONAL_ACCESS_TOKEN": github_token},
         timeout=300.0
@@ -63,6 +84,13 @@ async def connect_client():
     toolkit = MCPToolkit(servers=[coral_server, github_client])
     return toolkit
 
+def strip_titles(schema):
+    if isinstance(schema, dict):
+        return {k: strip_titles(v) for k, v in schema.items() if not (k == "title" and isinstance(v, str))}
+    if isinstance(schema, list):
+        return [strip_titles(v) for v in schema]
+    return schema
+
 async def get_tools_description(tools):
     descriptions = []
     for tool in tools:
@@ -70,15 +98,40 @@ async def get_tools_description(tools):
         schema = tool.get_openai_function_schema() or {}
         arg_names = list(schema.get('parameters', {}).get('properties', {}).keys()) if schema else []
         description = tool.get_function_description() or 'No description'
-        schema_str = json.dumps(schema, default=str).replace('{', '{{').replace('}', '}}')
+        schema_str = orjson.dumps(strip_titles(schema), default=str).decode().translate(BRACE_ESCAPE)
         descriptions.append(
             f"Tool: {tool_name}, Args: {arg_names}, Description: {description}, Schema: {schema_str}"
         )
     return "\n".join(descriptions)
 
-async def create_codediff_agent(toolkit):
-    tools = toolkit.get_tools()
-    tools_description = await get_tools_description(tools)
+def cache_pull_request_files(tools):
+    """Wrap the GitHub MCP `get_pull_request_files` tool so repeat requests for an unchanged PR skip the fetch."""
+    def wrap(pr_files_tool):
+        fetch = pr_files_tool.func
+
+        async def get_pull_request_files(**kwargs):
+            repo = kwargs.get("repo", "")
+            repo_full_name = repo if "/" in repo else f"{kwargs.get('owner')}/{repo}"
+            try:
+                pr_number = int(kwargs["pullNumber"])
+                head_sha = await asyncio.to_thread(lambda: get_repo(repo_full_name).get_pull(pr_number).head.sha)
+            except Exception as e:
+                logger.warning(f"Could not resolve PR head for {repo_full_name}, fetching without cache: {e}")
+                return await fetch(**kwargs)
+
+            key = (repo_full_name, pr_number, head_sha)
+            if key not in _pr_files_cache:
+                if len(_pr_files_cache) >= PR_FILES_CACHE_SIZE:
+                    _pr_files_cache.pop(next(iter(_pr_files_cache)))
+                _pr_files_cache[key] = await fetch(**kwargs)
+            return _pr_files_cache[key]
+
+        return FunctionTool(get_pull_request_files, openai_tool_schema=pr_files_tool.get_openai_tool_schema())
+
+    return [wrap(tool) if tool.get_function_name() == "get_pull_request_files" else tool for tool in tools]
+
+async def create_codediff_agent(toolkit, tools_description):
+    tools = cache_pull_request_files(toolkit.get_tools())
     sys_msg = (
         f"""You are `codediff_review_agent`, responsible for retrieving and formatting code diffs from a GitHub pull request.
 
@@ -106,7 +159,7 @@ async def create_codediff_agent(toolkit):
     model = ModelFactory.create(
         model_platform=ModelPlatformType.GROQ,
         model_type=ModelType.GROQ_LLAMA_3_3_70B,
-        model_config_dict={"temperature": 0.3},
+        model_config_dict={"temperature": 0},
     )
     
     agent = ChatAgent(
@@ -123,7 +176,7 @@ async def main():
         tools_description = await get_tools_description(tools)
         logger.info(f"Tools Description:\n{tools_description}")
         
-        agent = await create_codediff_agent(connected_toolkit)
+        agent = await create_codediff_agent(connected_toolkit, tools_description)
         
         # Initial agent step
         await agent.astep("Initializing codediff_review_agent, checking for mentions from other agents.")
@@ -145,4 +198,7 @@ async def main():
                 await asyncio.sleep(5)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file
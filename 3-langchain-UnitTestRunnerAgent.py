@@ -1,13 +1,23 @@
 import asyncio
+import collections
+import functools
 import os
 import json
+import orjson
 import logging
-import subprocess
+import random
+import re
+import sys
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langchain.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
 from langchain.agents import create_tool_calling_agent, AgentExecutor
 from langchain_core.tools import tool
+try:
+    # libuv-based event loop: cheaper socket reads on the SSE streams; the stdlib loop is used without it
+    import uvloop
+except ImportError:
+    uvloop = None
 from dotenv import load_dotenv
 from anyio import ClosedResourceError
 import urllib.parse
@@ -30,14 +40,59 @@ params = {
 }
 query_string = urllib.parse.urlencode(params)
 MCP_SERVER_URL = f"{base_url}?{query_string}"
+# Step-by-step agent traces on stdout; off by default since they are written synchronously on every step
+VERBOSE = bool(int(os.getenv("AGENT_VERBOSE", "0")))
+PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts", "unit_test_runner.md")
 AGENT_NAME = "unit_test_runner_agent"
 
+# Static rules go first and stay byte-identical across calls so OpenAI's prompt cache can reuse the prefix
+with open(PROMPT_PATH, encoding="utf-8") as f:
+    SYSTEM_PROMPT = f.read()
+
+# Matches the per-test lines of pytest's `-rA` short test summary, e.g. "FAILED tests/test_x.py::test_y - ..."
+TEST_OUTCOME_RE = re.compile(r"^(PASSED|FAILED|ERROR|SKIPPED|XFAIL|XPASS) (\S+)", re.MULTILINE)
+# pytest section headers such as "===== FAILURES =====" or "=== short test summary info ==="
+SECTION_RE = re.compile(r"^=+ (.+?) =+$")
+# pytest's final tally, e.g. "1 failed, 3 passed in 0.12s" (wrapped in '=' without -q)
+SUMMARY_RE = re.compile(r"^=*\s*(.*\bin [\d.]+s\b.*?)\s*=*$")
+FAILURES_MAX_CHARS = 4000
+OUTPUT_MAX_LINES = 2000  # only the last lines of pytest output are kept in memory
+TEST_TIMEOUT = 600  # seconds before a pytest run is killed
+PYTEST_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pytest_worker.py")
+PYTEST_DONE_MARKER = "@@pytest-worker-done@@"  # must match DONE_MARKER in pytest_worker.py
+
+# (project_root, process) of the long-lived pytest worker, so pytest and its plugins are imported once per project
+_pytest_worker = None
+_pytest_worker_lock = asyncio.Lock()
+
 # Validate API keys
 if not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY is not set in environment variables.")
 
+# Escapes braces in one pass so tool schemas survive ChatPromptTemplate formatting
+BRACE_ESCAPE = str.maketrans({"{": "{{", "}": "}}"})
+
+# Tool name -> compact, brace-escaped JSON schema
+_tool_schemas = {}
+
+# Sorted tool names -> AgentExecutor, reused across reconnects
+_executor_cache = {}
+
+def strip_titles(schema):
+    if isinstance(schema, dict):
+        return {k: strip_titles(v) for k, v in schema.items() if not (k == "title" and isinstance(v, str))}
+    if isinstance(schema, list):
+        return [strip_titles(v) for v in schema]
+    return schema
+
+def get_tool_schema(tool):
+    # Memoized by tool name: schemas do not change across reconnects
+    if tool.name not in _tool_schemas:
+        _tool_schemas[tool.name] = orjson.dumps(strip_titles(tool.args)).decode().translate(BRACE_ESCAPE)
+    return _tool_schemas[tool.name]
+
 def get_tools_description(tools):
-    return "\n".join(f"Tool: {t.name}, Schema: {json.dumps(t.args).replace('{', '{{').replace('}', '}}')}" for t in tools)
+    return "\n".join(f"Tool: {t.name}, Schema: {get_tool_schema(t)}" for t in tools)
 
 @tool
 def list_project_files(root_path: str) -> List[str]:
@@ -70,6 +125,12 @@ def list_project_files(root_path: str) -> List[str]:
 
     return file_list
 
+@functools.lru_cache(maxsize=64)
+def read_file_cached(full_path: str, mtime_ns: int, size: int) -> str:
+    # mtime_ns and size are part of the cache key, so an edited file is read again
+    with open(full_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
 @tool
 def read_project_files(root_path: str, relative_paths: List[str]) -> Dict[str, str]:
     """
@@ -92,82 +153,146 @@ def read_project_files(root_path: str, relative_paths: List[str]) -> Dict[str, s
         full_path = os.path.normpath(os.path.join(root_path, rel_path))
         if not os.path.isfile(full_path):
             raise ValueError(f"File '{rel_path}' does not exist under '{root_path}'.")
-        # Read and store file content
+        # Read and store file content, reusing the cached copy while the file is unchanged
         try:
-            with open(full_path, 'r', encoding='utf-8') as f:
-                contents[rel_path] = f.read()
+            stat = os.stat(full_path)
+            contents[rel_path] = read_file_cached(full_path, stat.st_mtime_ns, stat.st_size)
         except Exception as e:
             raise IOError(f"Failed to read '{full_path}': {e}")
     return contents
 
+def extract_failures(lines):
+    # Keep the FAILURES/ERRORS tracebacks and the FAILED/ERROR summary lines; passing-test chatter is dropped
+    failures = []
+    in_failures = False
+    for line in lines:
+        header = SECTION_RE.match(line)
+        if header:
+            in_failures = header.group(1) in ("FAILURES", "ERRORS")
+            continue
+        if in_failures or line.startswith(("FAILED ", "ERROR ")):
+            failures.append(line)
+    return "\n".join(failures)[:FAILURES_MAX_CHARS]
+
+async def get_pytest_worker(project_root):
+    global _pytest_worker
+    if _pytest_worker is not None:
+        root, proc = _pytest_worker
+        if root == project_root and proc.returncode is None:
+            return proc
+        await stop_pytest_worker()
+
+    env = os.environ.copy()
+    env["PYTHONPATH"] = project_root
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-u", PYTEST_WORKER_PATH,
+        cwd=project_root,
+        env=env,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=1024 * 1024
+    )
+    _pytest_worker = (project_root, proc)
+    logger.info(f"Started pytest worker for {project_root}")
+    return proc
+
+async def stop_pytest_worker():
+    global _pytest_worker
+    if _pytest_worker is not None:
+        _, proc = _pytest_worker
+        _pytest_worker = None
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+
 @tool
-def run_test(project_root: str, relative_test_path: str) -> dict:
+async def run_test(project_root: str, relative_test_paths: List[str]) -> dict:
     """
-    Run all pytest unit tests in a test file within a project directory.
+    Run pytest on one or more test files or test node ids within a project directory, using a single pytest process.
 
     Args:
         project_root (str): Absolute path to the project root directory.
-        relative_test_path (str): Path to the test file relative to the project root (e.g., 'tests/test_calculator.py').
+        relative_test_paths (List[str]): Test files or pytest node ids relative to the project root
+            (e.g., ['tests/test_calculator.py', 'tests/test_utils.py::test_parse']).
 
     Returns:
-        dict: Contains 'result' message, 'output' (full pytest output), and 'status' (True if all tests passed).
+        dict: Contains 'result' message, 'summary' (pytest's final tally line), 'tests' (outcome per test node id),
+            'failures' (failure tracebacks and FAILED/ERROR lines, empty on success), and 'status' (True if all tests passed).
     """
     if not os.path.isabs(project_root):
         raise ValueError("project_root must be an absolute path.")
 
-    abs_test_path = os.path.join(project_root, relative_test_path)
+    for relative_test_path in relative_test_paths:
+        abs_test_path = os.path.join(project_root, relative_test_path.split("::", 1)[0])
+        if not os.path.exists(abs_test_path):
+            raise FileNotFoundError(f"Test file does not exist: {abs_test_path}")
 
-    if not os.path.exists(abs_test_path):
-        raise FileNotFoundError(f"Test file does not exist: {abs_test_path}")
-
-    command = ["pytest", relative_test_path]
-    env = os.environ.copy()
-    env["PYTHONPATH"] = project_root
-
-    print(f"Running pytest on: {relative_test_path}")
-    result = subprocess.run(command, cwd=project_root, env=env, capture_output=True, text=True)
+    args = [*relative_test_paths, "-q", "--no-header", "-rA", "--tb=short", "-p", "no:cacheprovider", "-p", "no:randomly"]
 
+    print(f"Running pytest on: {', '.join(relative_test_paths)}")
+    # Stream the output as it is produced, keeping only a bounded tail in memory
     print("--- Pytest Output ---")
-    print(result.stdout)
-
-    passed = result.returncode == 0
-    status_msg = "All tests passed." if passed else "Some tests failed."
+    lines = collections.deque(maxlen=OUTPUT_MAX_LINES)
+    exit_code = None
+
+    async def collect_output(proc):
+        nonlocal exit_code
+        async for line in proc.stdout:
+            line = line.decode(errors="replace").rstrip("\n")
+            if line.startswith(PYTEST_DONE_MARKER):
+                exit_code = json.loads(line[len(PYTEST_DONE_MARKER):])["exit_code"]
+                return
+            print(line)
+            lines.append(line)
+
+    timed_out = False
+    async with _pytest_worker_lock:
+        try:
+            proc = await get_pytest_worker(project_root)
+            proc.stdin.write((json.dumps(args) + "\n").encode())
+            await proc.stdin.drain()
+            await asyncio.wait_for(collect_output(proc), TEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            timed_out = True
+        finally:
+            if exit_code is None:
+                # Timed out, cancelled, an unreadable output line or a dead worker: its unread output would
+                # be taken for the next run's result, so the next run starts a fresh one
+                await stop_pytest_worker()
+    output = "\n".join(lines)
+
+    passed = exit_code == 0
+    if timed_out:
+        status_msg = f"Pytest timed out after {TEST_TIMEOUT} seconds and was killed."
+    else:
+        status_msg = "All tests passed." if passed else "Some tests failed."
+
+    summary = next((m.group(1) for m in map(SUMMARY_RE.match, reversed(lines)) if m), "")
 
     return {
         "result": status_msg,
-        "output": result.stdout,
+        "summary": summary,
+        "tests": {m.group(2): m.group(1) for m in TEST_OUTCOME_RE.finditer(output)},
+        "failures": "" if passed else extract_failures(lines),
         "status": passed
     }
 
 
-async def create_unit_test_runner_agent(client, tools):
+async def create_unit_test_runner_agent(client, tools, tools_description):
     prompt = ChatPromptTemplate.from_messages([
-        ("system", f"""You are `unit_test_runner_agent`, responsible for running relevant pytest tests based on code diffs and a given project root.
-
-        1. Use `wait_for_mentions(timeoutMs=60000)` to wait for instructions from other agents.
-        2. When a mention is received, record the `threadId` and `senderId`.
-        3. Check if the message contains a project root and a list of filenames with code diffs.
-        4. Extract the `project_root` and the list of `(filename, diff snippet)` pairs, call `send_message(senderId=..., mentions=[senderId], threadId=..)` if any information is missing.
-        5. Call `list_project_files(project_root)` to get all files in the project.
-        6. Filter out test files related to the list of filenames with code diffs.
-        7. Call `read_project_files(project_root, test_files)` to read their content.
-        8. For each changed file, find related test files using name or import matching.
-        9. For each test file, call `run_test(project_root, test_file_path)` to run tests.
-        10. Collect the test output and compare executed test functions with all defined ones.
-        11. Format a result summary with test outcomes and pytest output.
-        12. Use `send_message(senderId=..., mentions=[senderId], threadId=..., content="answer")` to reply.
-        13. If there's an error, send a message with content `"error"` to the sender.
-        14. Always respond to the sender, even if the result is empty or invalid.
-        15. Wait 2 seconds and repeat from step 1. 
-        Tools: {get_tools_description(tools)}"""),
+        ("system", SYSTEM_PROMPT),
+        ("system", f"Tools: {tools_description}"),
         ("placeholder", "{agent_scratchpad}")
     ])
 
     model = ChatOpenAI(
-        model="gpt-4.1-2025-04-14",
+        model="gpt-4.1-mini-2025-04-14",
         api_key=os.getenv("OPENAI_API_KEY"),
-        temperature=0.3,
-        max_tokens=8192  # or 16384, 32768 depending on your needs; for gpt-4o-mini, make sure prompt + history + output < 128k tokens
+        temperature=0,
+        streaming=True,
+        stream_usage=True,
+        max_tokens=4096  # test summaries are short; make sure prompt + history + output < 128k tokens
     )
 
     '''model = ChatGroq(
@@ -178,36 +303,87 @@ async def create_unit_test_runner_agent(client, tools):
     #model = ChatOllama(model="llama3")
 
     agent = create_tool_calling_agent(model, tools, prompt)
-    return AgentExecutor(agent=agent, tools=tools, max_iterations=100, verbose=True)
+    return AgentExecutor(agent=agent, tools=tools, max_iterations=100, verbose=VERBOSE)
+
+async def get_agent_executor(client, tools, tools_description):
+    # A reconnect yields the same tools bound to a new session: keep the executor (prompt, model,
+    # tool schemas already bound to it) and only swap in the new tool objects
+    key = tuple(sorted(tool.name for tool in tools))
+    agent_executor = _executor_cache.get(key)
+    if agent_executor is None:
+        agent_executor = _executor_cache[key] = await create_unit_test_runner_agent(client, tools, tools_description)
+    else:
+        agent_executor.tools = tools
+    return agent_executor
+
+async def connect_client():
+    client = MultiServerMCPClient(connections={
+        "coral": {"transport": "sse", "url": MCP_SERVER_URL, "timeout": 300, "sse_read_timeout": 300}
+    })
+    await client.__aenter__()
+    return client
+
+async def disconnect_client(client):
+    if client is not None:
+        try:
+            await client.__aexit__(None, None, None)
+        except Exception as e:
+            logger.warning(f"Error while closing MCP client: {e}")
+    return None
+
+RETRY_BASE_DELAY = 1.0  # seconds
+RETRY_MAX_DELAY = 60.0  # seconds
+
+async def backoff(attempt):
+    # Exponential backoff with full jitter, so agents that fail together do not reconnect in lockstep
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    logger.info(f"Retrying in {delay:.1f} seconds...")
+    await asyncio.sleep(delay)
 
 async def main():
-    retry_delay = 5  # seconds
     max_retries = 5
     retries = max_retries
-
-    while retries > 0:
-        try:
-            async with MultiServerMCPClient(connections={
-                "coral": {"transport": "sse", "url": MCP_SERVER_URL, "timeout": 300, "sse_read_timeout": 300}
-            }) as client:
-                tools = client.get_tools() + [run_test, list_project_files, read_project_files]
-                logger.info(f"Connected to MCP server. Tools:\n{get_tools_description(tools)}")
-                retries = max_retries  # Reset retries on successful connection
-                await (await create_unit_test_runner_agent(client, tools)).ainvoke({})
-        except ClosedResourceError as e:
-            retries -= 1
-            logger.error(f"Connection closed: {str(e)}. Retries left: {retries}. Retrying in {retry_delay} seconds...")
-            if retries == 0:
-                logger.error("Max retries reached. Exiting.")
-                break
-            await asyncio.sleep(retry_delay)
-        except Exception as e:
-            retries -= 1
-            logger.error(f"Unexpected error: {str(e)}. Retries left: {retries}. Retrying in {retry_delay} seconds...")
-            if retries == 0:
-                logger.error("Max retries reached. Exiting.")
-                break
-            await asyncio.sleep(retry_delay)
+    client = None
+    agent_executor = None
+
+    try:
+        while retries > 0:
+            try:
+                if agent_executor is None:
+                    client = await connect_client()
+                    tools = client.get_tools() + [run_test, list_project_files, read_project_files]
+                    # Sorted so the tool list, and with it the prompt prefix, is identical across sessions
+                    tools.sort(key=lambda tool: tool.name)
+                    tools_description = get_tools_description(tools)
+                    logger.info(f"Connected to MCP server. Tools:\n{tools_description}")
+                    retries = max_retries  # Reset retries on successful connection
+                    agent_executor = await get_agent_executor(client, tools, tools_description)
+                await agent_executor.ainvoke({})
+            except ClosedResourceError as e:
+                retries -= 1
+                logger.error(f"Connection closed: {str(e)}. Retries left: {retries}. Reconnecting...")
+                # The SSE connection is gone, so the next attempt has to reconnect
+                client, agent_executor = await disconnect_client(client), None
+                if retries == 0:
+                    logger.error("Max retries reached. Exiting.")
+                    break
+                await backoff(max_retries - retries - 1)
+            except Exception as e:
+                retries -= 1
+                logger.error(f"Unexpected error: {str(e)}. Retries left: {retries}.")
+                if agent_executor is None:
+                    # Failed while connecting; start over with a fresh client
+                    client = await disconnect_client(client)
+                if retries == 0:
+                    logger.error("Max retries reached. Exiting.")
+                    break
+                await backoff(max_retries - retries - 1)
+    finally:
+        await disconnect_client(client)
+        await stop_pytest_worker()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -1,24 +1,36 @@
 import asyncio
 import os
-import json
+import orjson
 import logging
-from typing import List
+import random
+import re
+from typing import Dict, List
 from github import Github
 from github.ContentFile import ContentFile
 from github.GithubException import GithubException
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from langchain.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
-from langchain.agents import create_tool_calling_agent, AgentExecutor
+from langchain.agents import AgentExecutor
+from langchain.agents.format_scratchpad.tools import format_to_tool_messages
+from langchain.agents.output_parsers.tools import ToolsAgentOutputParser
+from langchain_core.runnables import RunnableBranch, RunnablePassthrough
 from langchain_core.tools import tool
 from langchain_community.callbacks import get_openai_callback
 from langchain.memory import ConversationSummaryMemory
 from langchain_core.memory import BaseMemory
+from langchain_core.messages import HumanMessage
+try:
+    # libuv-based event loop: cheaper socket reads on the SSE streams; the stdlib loop is used without it
+    import uvloop
+except ImportError:
+    uvloop = None
 from dotenv import load_dotenv
+from get_all_github_files import get_all_github_files as fetch_github_file_paths
+from retrieve_github_file_content import retrieve_github_file_content as fetch_github_file_content
+from retrieve_github_file_content import retrieve_github_files_batch as fetch_github_files_batch
 from anyio import ClosedResourceError
 import urllib.parse
-import base64
-import subprocess
 from langchain_groq import ChatGroq
 
 
@@ -38,20 +50,61 @@ params = {
 }
 query_string = urllib.parse.urlencode(params)
 MCP_SERVER_URL = f"{base_url}?{query_string}"
+# Step-by-step agent traces on stdout; off by default since they are written synchronously on every step
+VERBOSE = bool(int(os.getenv("AGENT_VERBOSE", "0")))
+PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts", "repo_unit_test_advisor.md")
 AGENT_NAME = "repo_unit_test_advisor_agent"
 
+# Static rules go first and stay byte-identical across calls so OpenAI's prompt cache can reuse the prefix
+# (the file is read as a prompt template, so literal braces in it are doubled)
+with open(PROMPT_PATH, encoding="utf-8") as f:
+    SYSTEM_PROMPT = f.read()
+
+# A deployment serving one repository can name it up front: step 3 then states it instead of asking the
+# model to find it in every mention. Mentions are still awaited, since replies need their threadId/senderId.
+REPO_NAME = os.getenv("REPO_NAME")
+BRANCH = os.getenv("BRANCH")
+if REPO_NAME and BRANCH:
+    FIXED_REPO_STEP = f"3. The repository is `{REPO_NAME}` on branch `{BRANCH}`. Use them for every call below, and parse the message only for the **list of target files** to evaluate; call `send_message(senderId=..., mentions=[senderId], threadId=..)` if it is missing."
+    SYSTEM_PROMPT = re.sub(r"^3\. .*$", lambda _: FIXED_REPO_STEP, SYSTEM_PROMPT, count=1, flags=re.MULTILINE)
+
+# Tools returning file content; the turn after one of these is the coverage analysis
+ANALYSIS_TOOLS = {"analyze_target_files", "retrieve_github_files_batch", "retrieve_github_file_content_tool"}
+MAX_CONCURRENT_FETCHES = 10  # stays clear of GitHub's secondary rate limits on concurrent requests
+
 # Validate API keys
 if not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY is not set in environment variables.")
 
+# Escapes braces in one pass so tool schemas survive ChatPromptTemplate formatting
+BRACE_ESCAPE = str.maketrans({"{": "{{", "}": "}}"})
+
+# Tool name -> compact, brace-escaped JSON schema
+_tool_schemas = {}
+
+# Sorted tool names -> AgentExecutor, reused across reconnects
+_executor_cache = {}
+
+def strip_titles(schema):
+    if isinstance(schema, dict):
+        return {k: strip_titles(v) for k, v in schema.items() if not (k == "title" and isinstance(v, str))}
+    if isinstance(schema, list):
+        return [strip_titles(v) for v in schema]
+    return schema
+
+def get_tool_schema(tool):
+    # Memoized by tool name: schemas do not change across reconnects
+    if tool.name not in _tool_schemas:
+        _tool_schemas[tool.name] = orjson.dumps(strip_titles(tool.args)).decode().translate(BRACE_ESCAPE)
+    return _tool_schemas[tool.name]
+
 def get_tools_description(tools):
-    return "\n".join(f"Tool: {t.name}, Schema: {json.dumps(t.args).replace('{', '{{').replace('}', '}}')}" for t in tools)
+    return "\n".join(f"Tool: {t.name}, Schema: {get_tool_schema(t)}" for t in tools)
 
-    
 @tool
 def get_all_github_files_tool(repo_name: str, branch: str = "main") -> str:
     """
-    Call the local get_all_github_files.py script and return all file paths in the specified repo and branch as a string.
+    Return all file paths in the specified repo and branch as a string.
 
     Args:
         repo_name (str): Full repository name in the format "owner/repo".
@@ -60,30 +113,16 @@ def get_all_github_files_tool(repo_name: str, branch: str = "main") -> str:
     Returns:
         str: All file paths (one per line), or error message.
     """
-    current_dir = os.path.abspath(os.path.dirname(__file__))
-    script_path = os.path.join(current_dir, "get_all_github_files.py")
-
-    result = subprocess.run(
-        [
-            "python",
-            script_path,
-            "--repo_name", repo_name,
-            "--branch", branch
-        ],
-        capture_output=True,
-        text=True
-    )
-    if result.returncode == 0:
-        return result.stdout
-    else:
-        return f"exit_code={result.returncode}\nstderr={result.stderr}"
-
-
+    # Called in-process so the tree listing cache in get_all_github_files.py is reused across calls
+    try:
+        return "\n".join(fetch_github_file_paths(repo_name, branch))
+    except Exception as e:
+        return f"ERROR: {e}"
 
 @tool
 def retrieve_github_file_content_tool(repo_name: str, file_path: str, branch: str = "main") -> str:
     """
-    Call the local retrieve_github_file_content.py script and return the file content or error.
+    Retrieve the content of a file from the specified repo and branch.
 
     Args:
         repo_name (str): Full repository name in the format "owner/repo".
@@ -91,28 +130,78 @@ def retrieve_github_file_content_tool(repo_name: str, file_path: str, branch: st
         branch (str): Branch name to retrieve the file from.
 
     Returns:
-        str: Script output (file content or error message).
+        str: File content, or error message.
     """
-    # Get the absolute path of the current directory
-    current_dir = os.path.abspath(os.path.dirname(__file__))
-    script_path = os.path.join(current_dir, "retrieve_github_file_content.py")
-
-    result = subprocess.run(
-        [
-            "python",
-            script_path,
-            "--repo_name", repo_name,
-            "--file_path", file_path,
-            "--branch", branch
-        ],
-        capture_output=True,
-        text=True
-    )
-    if result.returncode == 0:
-        return result.stdout
-    else:
-        return f"exit_code={result.returncode}\nstderr={result.stderr}"
+    # Called in-process so unchanged files are served from the blob SHA cache in retrieve_github_file_content.py
+    try:
+        return fetch_github_file_content(repo_name, file_path, branch)
+    except Exception as e:
+        return f"ERROR: {e}"
+
+
+@tool
+def retrieve_github_files_batch(repo_name: str, file_paths: List[str], branch: str = "main") -> Dict[str, str]:
+    """
+    Retrieve the content of several files from the same repo and branch in one request.
+
+    Args:
+        repo_name (str): Full repository name in the format "owner/repo".
+        file_paths (List[str]): Paths to the files in the repository.
+        branch (str): Branch name to retrieve the files from.
+
+    Returns:
+        Dict[str, str]: File path -> file content (or an error message for that file),
+            or {"error": ...} if the whole request failed.
+    """
+    try:
+        return fetch_github_files_batch(repo_name, file_paths, branch)
+    except Exception as e:
+        return {"error": f"ERROR: {e}"}
+
+def find_test_files(target_path, all_paths):
+    stem = os.path.splitext(os.path.basename(target_path))[0]
+    test_names = {f"test_{stem}", f"{stem}_test", f"{stem}.test", f"{stem}.spec"}
+    return [
+        path for path in all_paths
+        if path != target_path and os.path.splitext(os.path.basename(path))[0] in test_names
+    ]
+
+async def fetch_file_content(semaphore, repo_name, file_path, branch):
+    async with semaphore:
+        try:
+            return await asyncio.to_thread(fetch_github_file_content, repo_name, file_path, branch)
+        except Exception as e:
+            return f"ERROR: {e}"
 
+@tool
+async def analyze_target_files(repo_name: str, branch: str, target_paths: List[str]) -> Dict[str, dict]:
+    """
+    Fetch every target file together with its unit test files (matched by naming convention), all concurrently.
+
+    Args:
+        repo_name (str): Full repository name in the format "owner/repo".
+        branch (str): Branch name to retrieve the files from.
+        target_paths (List[str]): Paths of the target files to evaluate.
+
+    Returns:
+        Dict[str, dict]: Target path -> {"content": target file content,
+            "tests": {test file path: test file content}}, or {"error": ...} if the file list failed.
+            Files that could not be read carry an "ERROR: ..." string as their content.
+    """
+    try:
+        all_paths = await asyncio.to_thread(fetch_github_file_paths, repo_name, branch)
+    except Exception as e:
+        return {"error": f"ERROR: {e}"}
+
+    test_paths = {target: find_test_files(target, all_paths) for target in target_paths}
+    paths = list(dict.fromkeys([*target_paths, *(p for tests in test_paths.values() for p in tests)]))
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_FETCHES)
+    contents = dict(zip(paths, await asyncio.gather(*(fetch_file_content(semaphore, repo_name, p, branch) for p in paths))))
+
+    return {
+        target: {"content": contents[target], "tests": {p: contents[p] for p in test_paths[target]}}
+        for target in target_paths
+    }
 
 class HeadSummaryMemory(BaseMemory):
     def __init__(self, llm, head_n=3):
@@ -125,26 +214,24 @@ class HeadSummaryMemory(BaseMemory):
         user_msg = inputs.get("input") or next(iter(inputs.values()), "")
         ai_msg = outputs.get("output") or next(iter(outputs.values()), "")
         self._messages.append({"input": user_msg, "output": ai_msg})
+        # Only the turn that drops out of the window gets summarized, one LLM call per eviction
         if len(self._messages) > self.head_n:
-            self.summary_memory.save_context(inputs, outputs)
+            evicted = self._messages.pop(0)
+            self.summary_memory.save_context({"input": evicted["input"]}, {"output": evicted["output"]})
 
     def load_memory_variables(self, inputs):
-        messages = []
-        
-        for i in range(min(self._head_n, len(self._messages))):
-            msg = self._messages[i]
-            messages.append(HumanMessage(content=msg['input']))
-            messages.append(AIMessage(content=msg['output']))
-        # summary
-        if len(self._messages) > self._head_n:
-            summary_var = self.summary_memory.load_memory_variables(inputs).get("history", [])
-            if summary_var:
-                
-                if isinstance(summary_var, str):
-                    messages.append(HumanMessage(content="[Earlier Summary]\n" + summary_var))
-                elif isinstance(summary_var, list):
-                    messages.extend(summary_var)
-        return {"history": messages}
+        # Pack the summary and recent turns into one message of prefixed lines; far fewer
+        # tokens than a Human/AI message pair per turn
+        lines = []
+        summary_var = self.summary_memory.load_memory_variables(inputs).get("history", "")
+        if isinstance(summary_var, list):
+            summary_var = "\n".join(m.content for m in summary_var)
+        if summary_var:
+            lines.append(f"S|{summary_var}")
+        for msg in self._messages:
+            lines.append(f"U|{msg['input']}")
+            lines.append(f"A|{msg['output']}")
+        return {"history": [HumanMessage(content="\n".join(lines))] if lines else []}
 
     def clear(self):
         self._messages.clear()
@@ -170,44 +257,10 @@ class HeadSummaryMemory(BaseMemory):
     def summary_memory(self, value):
         self._summary_memory = value
 
-async def create_repo_unit_test_advisor_agent(client, tools):
+async def create_repo_unit_test_advisor_agent(client, tools, tools_description):
     prompt = ChatPromptTemplate.from_messages([
-        ("system", f"""You are `repo_unit_test_advisor_agent`, responsible for evaluating whether the unit tests in a specified GitHub repository
-        and branch sufficiently cover the necessary aspects of **specific target files**, and if additional tests are needed. 
-        You can only use the provided tools. Follow this workflow:
-
-        1. Use `wait_for_mentions(timeoutMs=60000)` to wait for instructions from other agents.
-        2. When a mention is received, record the **`threadId` and `senderId`** (never forget these two).
-        3. Parse the message to extract the `repo` name, `owner`, `branch`, and the **list of target files** to evaluate, call `send_message(senderId=..., mentions=[senderId], threadId=..)` if any three of above information is missing (especially the target files).
-        4. Call `get_all_github_files(repo_name=..., branch=...)` to obtain the complete file list, call `send_message(senderId=..., mentions=[senderId], threadId=..)` if the function call failed by invaild parameters.
-        5. For each target file:
-
-        * Use `retrieve_github_file_content_tool(repo_name=..., file_path=..., branch=...)` to read the file content (one file at a time).
-        * Identify its associated unit test file(s) (e.g., by naming convention, test folder, or import statements).
-        * For each unit test file, retrieve its content using `retrieve_github_file_content_tool(repo_name=..., file_path=..., branch=...)`, 
-          if you fail to call retrieve_github_file_content_tool, please read the file list again and re-exam the input parameters then re-call it.
-        * **Analyze the source code and test code:**
-
-            * What classes/functions in the target file are tested?
-            * Which aspects (edge cases, error handling, typical use, etc.) are covered?
-            * Are there any functions/classes/methods in the target file that are **not** covered by tests?
-            * If the target file primarily acts as a wrapper or proxy for other modules, 
-              or if its unit tests heavily mock or delegate to external dependencies, 
-              you should recursively retrieve and analyze those imported files and their tests to ensure comprehensive coverage. 
-              Otherwise, focus on the target file and its direct tests only.
-        6. For each target file, provide a concise report:
-
-        * **Coverage summary:** Which components are covered by tests? Which are missing?
-        * **Recommendations:** Are additional tests needed? What specific aspects or cases should be tested?
-        * If coverage assessment is inconclusive (e.g., due to missing files or circular imports), clearly state this.
-        7. Use `send_message(senderId=..., mentions=[senderId], threadId=..., content="your report")` to send your findings to the sender.
-        8. If you encounter an error, reply with content `"error"` to the sender.
-        9. Always respond to the sender thorugh calling `send_message`, even if your result is empty or inconclusive.
-        10. Wait 2 seconds and repeat from step 1.
-
-        **Important: NEVER EVER end the chain.**
-
-        Tools: {get_tools_description(tools)}"""),
+        ("system", SYSTEM_PROMPT),
+        ("system", f"Tools: {tools_description}"),
         ("placeholder", "{history}"),
         ("placeholder", "{agent_scratchpad}")
     ])
@@ -215,106 +268,162 @@ async def create_repo_unit_test_advisor_agent(client, tools):
     model = ChatOpenAI(
         model="gpt-4.1-2025-04-14",
         api_key=os.getenv("OPENAI_API_KEY"),
-        temperature=0.3,
-        max_tokens=32768,
+        temperature=0,
+        streaming=True,
+        stream_usage=True,
+        max_tokens=2048,  # the report is a compact JSON object
         request_timeout=120,    
         max_retries=8           
     )
 
+    # Waiting for mentions, listing files and picking test files is routine tool planning
+    mini_model = ChatOpenAI(
+        model="gpt-4.1-mini-2025-04-14",
+        api_key=os.getenv("OPENAI_API_KEY"),
+        temperature=0,
+        streaming=True,
+        stream_usage=True,
+        max_tokens=2048,
+        request_timeout=120,
+        max_retries=8
+    )
+
     '''model = ChatGroq(
         model="llama-3.3-70b-versatile",
         temperature=0.3
     )'''
 
-    memory = HeadSummaryMemory(llm=model, head_n=4)
+    memory = HeadSummaryMemory(llm=mini_model, head_n=4)
+
+    # Same pipeline as create_tool_calling_agent, but only turns that follow a file read (the coverage
+    # analysis) go to the full model; every other turn is answered by the mini model
+    def after_file_read(inputs):
+        steps = inputs["intermediate_steps"]
+        return bool(steps) and steps[-1][0].tool in ANALYSIS_TOOLS
+
+    agent = (
+        RunnablePassthrough.assign(agent_scratchpad=lambda x: format_to_tool_messages(x["intermediate_steps"]))
+        | RunnableBranch(
+            (after_file_read, prompt | model.bind_tools(tools)),
+            prompt | mini_model.bind_tools(tools)
+        )
+        | ToolsAgentOutputParser()
+    )
+    return AgentExecutor(agent=agent, tools=tools, memory=memory, max_iterations=100, handle_parsing_errors = True, verbose=VERBOSE)
+
+# Coral tools the agent may use; everything else the MCP server exposes is dropped
+CORAL_TOOLS = frozenset({
+    "list_agents",
+    "create_thread",
+    "add_participant",
+    "remove_participant",
+    "close_thread",
+    "send_message",
+    "wait_for_mentions",
+})
+
+def select_tools(all_tools, extras):
+    # Sorted so the tool list, and with it the prompt prefix, is identical across sessions
+    return sorted([tool for tool in all_tools if tool.name in CORAL_TOOLS] + extras, key=lambda tool: tool.name)
+
+async def get_agent_executor(client, tools, tools_description):
+    # A reconnect yields the same tools bound to a new session: keep the executor (prompt, model,
+    # tool schemas already bound to it, memory) and only swap in the new tool objects
+    key = tuple(sorted(tool.name for tool in tools))
+    agent_executor = _executor_cache.get(key)
+    if agent_executor is None:
+        agent_executor = _executor_cache[key] = await create_repo_unit_test_advisor_agent(client, tools, tools_description)
+    else:
+        agent_executor.tools = tools
+    return agent_executor
+
+async def connect_client():
+    # Only Coral tools are used over MCP; GitHub is read in-process by the tools above, so no
+    # github-mcp-server container is started
+    client = MultiServerMCPClient(
+        connections = {
+            "coral": {
+                "transport": "sse", 
+                "url": MCP_SERVER_URL, 
+                "timeout": 300, 
+                "sse_read_timeout": 300
+            }
+        }
+    )
+    await client.__aenter__()
+    logger.info(f"Connected to MCP server at {MCP_SERVER_URL}")
+    return client
+
+async def disconnect_client(client):
+    if client is not None:
+        try:
+            await client.__aexit__(None, None, None)
+        except Exception as e:
+            logger.warning(f"Error while closing MCP client: {e}")
+    return None
 
+RETRY_BASE_DELAY = 1.0  # seconds
+RETRY_MAX_DELAY = 60.0  # seconds
 
-    agent = create_tool_calling_agent(model, tools, prompt)
-    return AgentExecutor(agent=agent, tools=tools, memory=memory, max_iterations=100, handle_parsing_errors = True, verbose=True)
+async def backoff(attempt):
+    # Exponential backoff with full jitter, so agents that fail together do not reconnect in lockstep
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    logger.info(f"Retrying in {delay:.1f} seconds...")
+    await asyncio.sleep(delay)
 
 async def main():
     max_retries = 5
-    retry_delay = 5  # seconds
 
     github_token = os.getenv("GITHUB_ACCESS_TOKEN")
     if not github_token:
         raise ValueError("GITHUB_PERSONAL_ACCESS_TOKEN environment variable is required")
 
-    for attempt in range(max_retries):
-        try:
-            async with MultiServerMCPClient(
-                connections = {
-                    "coral": {
-                        "transport": "sse", 
-                        "url": MCP_SERVER_URL, 
-                        "timeout": 300, 
-                        "sse_read_timeout": 300
-                    },
-                    "github": {
-                        "transport": "stdio",
-                        "command": "docker",
-                        "args": [
-                            "run",
-                            "-i",
-                            "--rm",
-                            "-e",
-                            "GITHUB_PERSONAL_ACCESS_TOKEN",
-                            "ghcr.io/github/github-mcp-server"
-                        ],
-                        "env": {
-                            "GITHUB_PERSONAL_ACCESS_TOKEN": github_token
-                        }
-                    }
-                }
-            ) as client:
-                logger.info(f"Connected to MCP server at {MCP_SERVER_URL}")
-                coral_tool_names = [
-                    "list_agents",
-                    "create_thread",
-                    "add_participant",
-                    "remove_participant",
-                    "close_thread",
-                    "send_message",
-                    "wait_for_mentions",
-                ]
-
-                tools = client.get_tools()
-
-                tools = [
-                    tool for tool in tools
-                    if tool.name in coral_tool_names
-                ]
-
-                tools += [get_all_github_files_tool, retrieve_github_file_content_tool]
-
-                logger.info(f"Tools Description:\n{get_tools_description(tools)}")
+    client = None
+    agent_executor = None
+    try:
+        for attempt in range(max_retries):
+            try:
+                if agent_executor is None:
+                    client = await connect_client()
+                    tools = select_tools(client.get_tools(), [get_all_github_files_tool, retrieve_github_file_content_tool, retrieve_github_files_batch, analyze_target_files])
+
+                    tools_description = get_tools_description(tools)
+                    logger.info(f"Tools Description:\n{tools_description}")
+                    agent_executor = await get_agent_executor(client, tools, tools_description)
 
                 with get_openai_callback() as cb:
-                    agent_executor = await create_repo_unit_test_advisor_agent(client, tools)
                     await agent_executor.ainvoke({})
                     logger.info(f"Token usage for this run:")
                     logger.info(f"  Prompt Tokens: {cb.prompt_tokens}")
                     logger.info(f"  Completion Tokens: {cb.completion_tokens}")
                     logger.info(f"  Total Tokens: {cb.total_tokens}")
                     logger.info(f"  Total Cost (USD): ${cb.total_cost:.6f}")
-        except ClosedResourceError as e:
-            logger.error(f"ClosedResourceError on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                logger.error("Max retries reached. Exiting.")
-                raise
-        except Exception as e:
-            logger.error(f"Unexpected error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                logger.error("Max retries reached. Exiting.")
-                raise
+            except ClosedResourceError as e:
+                logger.error(f"ClosedResourceError on attempt {attempt + 1}: {e}")
+                # The SSE connection is gone, so the next attempt has to reconnect
+                client, agent_executor = await disconnect_client(client), None
+                if attempt < max_retries - 1:
+                    await backoff(attempt)
+                    continue
+                else:
+                    logger.error("Max retries reached. Exiting.")
+                    raise
+            except Exception as e:
+                logger.error(f"Unexpected error on attempt {attempt + 1}: {e}")
+                if agent_executor is None:
+                    # Failed while connecting; start over with a fresh client
+                    client = await disconnect_client(client)
+                if attempt < max_retries - 1:
+                    await backoff(attempt)
+                    continue
+                else:
+                    logger.error("Max retries reached. Exiting.")
+                    raise
+    finally:
+        await disconnect_client(client)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
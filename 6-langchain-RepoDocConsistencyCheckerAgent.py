@@ -1,8 +1,10 @@
 import asyncio
 import os
-import json
+import orjson
 import logging
-from typing import List
+import random
+import re
+from typing import Dict, List
 from github import Github
 from github.ContentFile import ContentFile
 from github.GithubException import GithubException
@@ -14,11 +16,18 @@ from langchain_core.tools import tool
 from langchain_community.callbacks import get_openai_callback
 from langchain.memory import ConversationSummaryMemory
 from langchain_core.memory import BaseMemory
+from langchain_core.messages import HumanMessage
+try:
+    # libuv-based event loop: cheaper socket reads on the SSE streams; the stdlib loop is used without it
+    import uvloop
+except ImportError:
+    uvloop = None
 from dotenv import load_dotenv
+from get_all_github_files import get_all_github_files as fetch_github_file_paths
+from retrieve_github_file_content import retrieve_github_file_content as fetch_github_file_content
+from retrieve_github_file_content import retrieve_github_files_batch as fetch_github_files_batch
 from anyio import ClosedResourceError
 import urllib.parse
-import base64
-import subprocess
 from langchain_groq import ChatGroq
 
 
@@ -38,20 +47,56 @@ params = {
 }
 query_string = urllib.parse.urlencode(params)
 MCP_SERVER_URL = f"{base_url}?{query_string}"
+# Step-by-step agent traces on stdout; off by default since they are written synchronously on every step
+VERBOSE = bool(int(os.getenv("AGENT_VERBOSE", "0")))
+PROMPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts", "repo_doc_consistency_checker.md")
 AGENT_NAME = "repo_doc_consistency_checker_agent"
 
+# Static rules go first and stay byte-identical across calls so OpenAI's prompt cache can reuse the prefix
+with open(PROMPT_PATH, encoding="utf-8") as f:
+    SYSTEM_PROMPT = f.read()
+
+# A deployment serving one repository can name it up front: step 3 then states it instead of asking the
+# model to find it in every mention. Mentions are still awaited, since replies need their threadId/senderId.
+REPO_NAME = os.getenv("REPO_NAME")
+BRANCH = os.getenv("BRANCH")
+if REPO_NAME and BRANCH:
+    FIXED_REPO_STEP = f"3. The repository is `{REPO_NAME}` on branch `{BRANCH}`. Use them for every call below, and parse the message only for the **list of changed files**; call `send_message(senderId=..., mentions=[senderId], threadId=...)` if it is missing."
+    SYSTEM_PROMPT = re.sub(r"^3\. .*$", lambda _: FIXED_REPO_STEP, SYSTEM_PROMPT, count=1, flags=re.MULTILINE)
+
 # Validate API keys
 if not os.getenv("OPENAI_API_KEY"):
     raise ValueError("OPENAI_API_KEY is not set in environment variables.")
 
+# Escapes braces in one pass so tool schemas survive ChatPromptTemplate formatting
+BRACE_ESCAPE = str.maketrans({"{": "{{", "}": "}}"})
+
+# Tool name -> compact, brace-escaped JSON schema
+_tool_schemas = {}
+
+# Sorted tool names -> AgentExecutor, reused across reconnects
+_executor_cache = {}
+
+def strip_titles(schema):
+    if isinstance(schema, dict):
+        return {k: strip_titles(v) for k, v in schema.items() if not (k == "title" and isinstance(v, str))}
+    if isinstance(schema, list):
+        return [strip_titles(v) for v in schema]
+    return schema
+
+def get_tool_schema(tool):
+    # Memoized by tool name: schemas do not change across reconnects
+    if tool.name not in _tool_schemas:
+        _tool_schemas[tool.name] = orjson.dumps(strip_titles(tool.args)).decode().translate(BRACE_ESCAPE)
+    return _tool_schemas[tool.name]
+
 def get_tools_description(tools):
-    return "\n".join(f"Tool: {t.name}, Schema: {json.dumps(t.args).replace('{', '{{').replace('}', '}}')}" for t in tools)
+    return "\n".join(f"Tool: {t.name}, Schema: {get_tool_schema(t)}" for t in tools)
 
-    
 @tool
 def get_all_github_files_tool(repo_name: str, branch: str = "main") -> str:
     """
-    Call the local get_all_github_files.py script and return all file paths in the specified repo and branch as a string.
+    Return all file paths in the specified repo and branch as a string.
 
     Args:
         repo_name (str): Full repository name in the format "owner/repo".
@@ -60,30 +105,16 @@ def get_all_github_files_tool(repo_name: str, branch: str = "main") -> str:
     Returns:
         str: All file paths (one per line), or error message.
     """
-    current_dir = os.path.abspath(os.path.dirname(__file__))
-    script_path = os.path.join(current_dir, "get_all_github_files.py")
-
-    result = subprocess.run(
-        [
-            "python",
-            script_path,
-            "--repo_name", repo_name,
-            "--branch", branch
-        ],
-        capture_output=True,
-        text=True
-    )
-    if result.returncode == 0:
-        return result.stdout
-    else:
-        return f"exit_code={result.returncode}\nstderr={result.stderr}"
-
-
+    # Called in-process so the tree listing cache in get_all_github_files.py is reused across calls
+    try:
+        return "\n".join(fetch_github_file_paths(repo_name, branch))
+    except Exception as e:
+        return f"ERROR: {e}"
 
 @tool
 def retrieve_github_file_content_tool(repo_name: str, file_path: str, branch: str = "main") -> str:
     """
-    Call the local retrieve_github_file_content.py script and return the file content or error.
+    Retrieve the content of a file from the specified repo and branch.
 
     Args:
         repo_name (str): Full repository name in the format "owner/repo".
@@ -91,28 +122,33 @@ def retrieve_github_file_content_tool(repo_name: str, file_path: str, branch: st
         branch (str): Branch name to retrieve the file from.
 
     Returns:
-        str: Script output (file content or error message).
+        str: File content, or error message.
     """
-    # Get the absolute path of the current directory
-    current_dir = os.path.abspath(os.path.dirname(__file__))
-    script_path = os.path.join(current_dir, "retrieve_github_file_content.py")
-
-    result = subprocess.run(
-        [
-            "python",
-            script_path,
-            "--repo_name", repo_name,
-            "--file_path", file_path,
-            "--branch", branch
-        ],
-        capture_output=True,
-        text=True
-    )
-    if result.returncode == 0:
-        return result.stdout
-    else:
-        return f"exit_code={result.returncode}\nstderr={result.stderr}"
+    # Called in-process so unchanged files are served from the blob SHA cache in retrieve_github_file_content.py
+    try:
+        return fetch_github_file_content(repo_name, file_path, branch)
+    except Exception as e:
+        return f"ERROR: {e}"
+
+
+@tool
+def retrieve_github_files_batch(repo_name: str, file_paths: List[str], branch: str = "main") -> Dict[str, str]:
+    """
+    Retrieve the content of several files from the same repo and branch in one request.
 
+    Args:
+        repo_name (str): Full repository name in the format "owner/repo".
+        file_paths (List[str]): Paths to the files in the repository.
+        branch (str): Branch name to retrieve the files from.
+
+    Returns:
+        Dict[str, str]: File path -> file content (or an error message for that file),
+            or {"error": ...} if the whole request failed.
+    """
+    try:
+        return fetch_github_files_batch(repo_name, file_paths, branch)
+    except Exception as e:
+        return {"error": f"ERROR: {e}"}
 
 class HeadSummaryMemory(BaseMemory):
     def __init__(self, llm, head_n=3):
@@ -125,26 +161,24 @@ class HeadSummaryMemory(BaseMemory):
         user_msg = inputs.get("input") or next(iter(inputs.values()), "")
         ai_msg = outputs.get("output") or next(iter(outputs.values()), "")
         self._messages.append({"input": user_msg, "output": ai_msg})
+        # Only the turn that drops out of the window gets summarized, one LLM call per eviction
         if len(self._messages) > self.head_n:
-            self.summary_memory.save_context(inputs, outputs)
+            evicted = self._messages.pop(0)
+            self.summary_memory.save_context({"input": evicted["input"]}, {"output": evicted["output"]})
 
     def load_memory_variables(self, inputs):
-        messages = []
-        
-        for i in range(min(self._head_n, len(self._messages))):
-            msg = self._messages[i]
-            messages.append(HumanMessage(content=msg['input']))
-            messages.append(AIMessage(content=msg['output']))
-        # summary
-        if len(self._messages) > self._head_n:
-            summary_var = self.summary_memory.load_memory_variables(inputs).get("history", [])
-            if summary_var:
-                
-                if isinstance(summary_var, str):
-                    messages.append(HumanMessage(content="[Earlier Summary]\n" + summary_var))
-                elif isinstance(summary_var, list):
-                    messages.extend(summary_var)
-        return {"history": messages}
+        # Pack the summary and recent turns into one message of prefixed lines; far fewer
+        # tokens than a Human/AI message pair per turn
+        lines = []
+        summary_var = self.summary_memory.load_memory_variables(inputs).get("history", "")
+        if isinstance(summary_var, list):
+            summary_var = "\n".join(m.content for m in summary_var)
+        if summary_var:
+            lines.append(f"S|{summary_var}")
+        for msg in self._messages:
+            lines.append(f"U|{msg['input']}")
+            lines.append(f"A|{msg['output']}")
+        return {"history": [HumanMessage(content="\n".join(lines))] if lines else []}
 
     def clear(self):
         self._messages.clear()
@@ -170,42 +204,21 @@ class HeadSummaryMemory(BaseMemory):
     def summary_memory(self, value):
         self._summary_memory = value
 
-async def create_doc_consistency_checker_agent(client, tools):
+async def create_doc_consistency_checker_agent(client, tools, tools_description):
     prompt = ChatPromptTemplate.from_messages([
-        ("system", f"""You are `repo_doc_consistency_checker_agent`, responsible for evaluating whether the documentation in a specified GitHub repository and branch is up-to-date with respect to the **changes in a provided list of files**.
-        You can only use the provided tools. Follow this workflow:
-
-        1. Use `wait_for_mentions(timeoutMs=60000)` to wait for instructions from other agents.
-        2. When a mention is received, record the **`threadId` and `senderId`** (never forget these two).
-        3. Parse the message to extract the `repo_name`, `owner`, `branch`, and the **list of changed files**. Call `send_message(senderId=..., mentions=[senderId], threadId=...)` if any of these is missing.
-        4. Call `get_all_github_files(repo_name=..., branch=...)` to get the list of all files in the repository for this branch.
-        5. For each file in the list of changed files:
-            * Use `retrieve_github_file_content_tool(repo_name=..., file_path=..., branch=...)` to read its content.
-            * Identify which documentation files (such as `README.md`, or `.md`/`.rst`/`.txt` files in the same directory or in `docs/`) are most likely to be relevant to the change.
-        6. For each relevant documentation file:
-            * Use `retrieve_github_file_content_tool(repo_name=..., file_path=..., branch=...)` to read its content.
-            * Check if the documentation is up-to-date with respect to the changes in the corresponding changed file (such as APIs, usage, dependencies, or configuration).
-        7. Prepare a brief report for the sender:
-            * List any documentation that is outdated or missing regarding the recent changes.
-            * Provide recommendations on what should be updated.
-            * If everything is already up to date, simply state that.
-        8. Use `send_message(senderId=..., mentions=[senderId], threadId=..., content="your report")` to send your findings.
-        9. If you encounter an error, reply with content `"error"` to the sender.
-        10. Always respond to the sender through calling `send_message`, even if your result is empty or inconclusive.
-        11. Wait 2 seconds and repeat from step 1.
-
-        **Important: NEVER EVER end the chain.**
-
-        Tools: {get_tools_description(tools)}"""),
+        ("system", SYSTEM_PROMPT),
+        ("system", f"Tools: {tools_description}"),
         ("placeholder", "{history}"),
         ("placeholder", "{agent_scratchpad}")
     ])
 
     model = ChatOpenAI(
-        model="gpt-4.1-2025-04-14",
+        model="gpt-4.1-mini-2025-04-14",
         api_key=os.getenv("OPENAI_API_KEY"),
-        temperature=0.3,
-        max_tokens=32768,
+        temperature=0,
+        streaming=True,
+        stream_usage=True,
+        max_tokens=4096,
         request_timeout=120,    
         max_retries=8           
     )
@@ -219,91 +232,121 @@ async def create_doc_consistency_checker_agent(client, tools):
 
 
     agent = create_tool_calling_agent(model, tools, prompt)
-    return AgentExecutor(agent=agent, tools=tools, memory=memory, max_iterations=100, handle_parsing_errors = True, verbose=True)
+    return AgentExecutor(agent=agent, tools=tools, memory=memory, max_iterations=100, handle_parsing_errors = True, verbose=VERBOSE)
+
+# Coral tools the agent may use; everything else the MCP server exposes is dropped
+CORAL_TOOLS = frozenset({
+    "list_agents",
+    "create_thread",
+    "add_participant",
+    "remove_participant",
+    "close_thread",
+    "send_message",
+    "wait_for_mentions",
+})
+
+def select_tools(all_tools, extras):
+    # Sorted so the tool list, and with it the prompt prefix, is identical across sessions
+    return sorted([tool for tool in all_tools if tool.name in CORAL_TOOLS] + extras, key=lambda tool: tool.name)
+
+async def get_agent_executor(client, tools, tools_description):
+    # A reconnect yields the same tools bound to a new session: keep the executor (prompt, model,
+    # tool schemas already bound to it, memory) and only swap in the new tool objects
+    key = tuple(sorted(tool.name for tool in tools))
+    agent_executor = _executor_cache.get(key)
+    if agent_executor is None:
+        agent_executor = _executor_cache[key] = await create_doc_consistency_checker_agent(client, tools, tools_description)
+    else:
+        agent_executor.tools = tools
+    return agent_executor
+
+async def connect_client():
+    # Only Coral tools are used over MCP; GitHub is read in-process by the tools above, so no
+    # github-mcp-server container is started
+    client = MultiServerMCPClient(
+        connections = {
+            "coral": {
+                "transport": "sse", 
+                "url": MCP_SERVER_URL, 
+                "timeout": 300, 
+                "sse_read_timeout": 300
+            }
+        }
+    )
+    await client.__aenter__()
+    logger.info(f"Connected to MCP server at {MCP_SERVER_URL}")
+    return client
+
+async def disconnect_client(client):
+    if client is not None:
+        try:
+            await client.__aexit__(None, None, None)
+        except Exception as e:
+            logger.warning(f"Error while closing MCP client: {e}")
+    return None
+
+RETRY_BASE_DELAY = 1.0  # seconds
+RETRY_MAX_DELAY = 60.0  # seconds
+
+async def backoff(attempt):
+    # Exponential backoff with full jitter, so agents that fail together do not reconnect in lockstep
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    logger.info(f"Retrying in {delay:.1f} seconds...")
+    await asyncio.sleep(delay)
 
 async def main():
     max_retries = 5
-    retry_delay = 5  # seconds
 
     github_token = os.getenv("GITHUB_ACCESS_TOKEN")
     if not github_token:
         raise ValueError("GITHUB_PERSONAL_ACCESS_TOKEN environment variable is required")
 
-    for attempt in range(max_retries):
-        try:
-            async with MultiServerMCPClient(
-                connections = {
-                    "coral": {
-                        "transport": "sse", 
-                        "url": MCP_SERVER_URL, 
-                        "timeout": 300, 
-                        "sse_read_timeout": 300
-                    },
-                    "github": {
-                        "transport": "stdio",
-                        "command": "docker",
-                        "args": [
-                            "run",
-                            "-i",
-                            "--rm",
-                            "-e",
-                            "GITHUB_PERSONAL_ACCESS_TOKEN",
-                            "ghcr.io/github/github-mcp-server"
-                        ],
-                        "env": {
-                            "GITHUB_PERSONAL_ACCESS_TOKEN": github_token
-                        }
-                    }
-                }
-            ) as client:
-                logger.info(f"Connected to MCP server at {MCP_SERVER_URL}")
-                coral_tool_names = [
-                    "list_agents",
-                    "create_thread",
-                    "add_participant",
-                    "remove_participant",
-                    "close_thread",
-                    "send_message",
-                    "wait_for_mentions",
-                ]
-
-                tools = client.get_tools()
-
-                tools = [
-                    tool for tool in tools
-                    if tool.name in coral_tool_names
-                ]
-
-                tools += [get_all_github_files_tool, retrieve_github_file_content_tool]
-
-                logger.info(f"Tools Description:\n{get_tools_description(tools)}")
+    client = None
+    agent_executor = None
+    try:
+        for attempt in range(max_retries):
+            try:
+                if agent_executor is None:
+                    client = await connect_client()
+                    tools = select_tools(client.get_tools(), [get_all_github_files_tool, retrieve_github_file_content_tool, retrieve_github_files_batch])
+
+                    tools_description = get_tools_description(tools)
+                    logger.info(f"Tools Description:\n{tools_description}")
+                    agent_executor = await get_agent_executor(client, tools, tools_description)
 
                 with get_openai_callback() as cb:
-                    agent_executor = await create_doc_consistency_checker_agent(client, tools)
                     await agent_executor.ainvoke({})
                     logger.info(f"Token usage for this run:")
                     logger.info(f"  Prompt Tokens: {cb.prompt_tokens}")
                     logger.info(f"  Completion Tokens: {cb.completion_tokens}")
                     logger.info(f"  Total Tokens: {cb.total_tokens}")
                     logger.info(f"  Total Cost (USD): ${cb.total_cost:.6f}")
-        except ClosedResourceError as e:
-            logger.error(f"ClosedResourceError on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                logger.error("Max retries reached. Exiting.")
-                raise
-        except Exception as e:
-            logger.error(f"Unexpected error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                await asyncio.sleep(retry_delay)
-                continue
-            else:
-                logger.error("Max retries reached. Exiting.")
-                raise
+            except ClosedResourceError as e:
+                logger.error(f"ClosedResourceError on attempt {attempt + 1}: {e}")
+                # The SSE connection is gone, so the next attempt has to reconnect
+                client, agent_executor = await disconnect_client(client), None
+                if attempt < max_retries - 1:
+                    await backoff(attempt)
+                    continue
+                else:
+                    logger.error("Max retries reached. Exiting.")
+                    raise
+            except Exception as e:
+                logger.error(f"Unexpected error on attempt {attempt + 1}: {e}")
+                if agent_executor is None:
+                    # Failed while connecting; start over with a fresh client
+                    client = await disconnect_client(client)
+                if attempt < max_retries - 1:
+                    await backoff(attempt)
+                    continue
+                else:
+                    logger.error("Max retries reached. Exiting.")
+                    raise
+    finally:
+        await disconnect_client(client)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -1,53 +1,232 @@
 import os
+import re
+import time
+import threading
 import argparse
+import collections
+import functools
+import importlib.util
+import types
+from typing import Dict, List, Mapping, Tuple
+from urllib.parse import quote
+import httpx
 from github import Github
-from github.ContentFile import ContentFile
 from github.GithubException import GithubException
 
-def get_all_github_files(repo_name: str, branch: str = "main"):
+GITHUB_API_URL = "https://api.github.com"
+# Vendored/build output directories and binary files: never worth listing to the LLM or fetching
+EXCLUDE_RE = re.compile(
+    r"(^|/)(node_modules|dist|build|target|__pycache__)/"
+    r"|\.(png|jpg|jpeg|gif|ico|pdf|zip|tar|gz|jar|class|pyc|so|dll|exe|bin|mp4|woff2?)$",
+    re.IGNORECASE,
+)
+BRANCH_HEAD_TTL = 30  # seconds a resolved branch head SHA is reused before asking GitHub again
+
+# (repo_name, branch) -> (resolved_at, commit SHA)
+_branch_heads = {}
+
+# (repo_name, branch) -> (ETag, commit SHA) of the last branch head response
+_branch_etags = {}
+
+# Shared across calls so GitHub connections are kept alive; over HTTP/2 (when `h2` is installed)
+# concurrent fetches are multiplexed on one TLS connection, otherwise it falls back to HTTP/1.1
+http_client = httpx.Client(
+    http2=importlib.util.find_spec("h2") is not None,
+    timeout=60,
+    limits=httpx.Limits(max_connections=20)
+)
+
+# One client per process so every call reuses the same authenticated HTTP session (keep-alive)
+_gh = None
+_gh_lock = threading.Lock()
+
+def get_github_client() -> Github:
+    """
+    Return the shared Github client, creating it on first use.
+
+    Raises:
+        ValueError: If GITHUB_ACCESS_TOKEN is not set.
+    """
+    global _gh
+    with _gh_lock:
+        if _gh is None:
+            token = os.getenv("GITHUB_ACCESS_TOKEN")
+            if not token:
+                raise ValueError("GITHUB_ACCESS_TOKEN environment variable is not set.")
+            _gh = Github(token, per_page=100)
+    return _gh
+
+@functools.lru_cache(maxsize=16)
+def get_repo(repo_name: str):
+    """Look up a repository once per process; failed lookups are not cached."""
+    try:
+        return get_github_client().get_repo(repo_name)
+    except GithubException as e:
+        raise GithubException(f"Failed to access repository '{repo_name}': {e.data}")
+
+@functools.lru_cache(maxsize=64)
+def get_tree_files(repo_name: str, sha: str) -> Tuple[Tuple[str, str], ...]:
+    """
+    List (path, blob SHA) for every file in a commit's tree with a single recursive Git Trees API call.
+
+    The result is cached by commit SHA; a new push to the branch changes the SHA and misses the cache.
+    """
+    repo = get_repo(repo_name)
+    try:
+        tree = repo.get_git_tree(sha, recursive=True)
+        if tree.truncated:
+            # Over GitHub's 100k entries / 7MB limit for one response: list directory by directory instead
+            return tuple(walk_tree(repo, sha))
+    except GithubException as e:
+        raise GithubException(f"Failed to get tree '{sha}' of repository '{repo_name}': {e.data}")
+    return tuple((entry.path, entry.sha) for entry in tree.tree if entry.type == "blob")
+
+def walk_tree(repo, sha):
+    # Breadth-first with an explicit queue: no recursion limit on deep trees, one output list
+    files = []
+    queue = collections.deque([(sha, "")])
+    while queue:
+        tree_sha, prefix = queue.popleft()
+        for entry in repo.get_git_tree(tree_sha).tree:
+            path = f"{prefix}{entry.path}"
+            if entry.type == "blob":
+                files.append((path, entry.sha))
+            elif entry.type == "tree":
+                queue.append((entry.sha, f"{path}/"))
+    return files
+
+@functools.lru_cache(maxsize=256)
+def get_tree_entries(repo_name: str, sha: str) -> Tuple[Tuple[str, str, str], ...]:
+    """(name, type, SHA) of the direct children of one tree, cached by SHA like the recursive listing."""
+    try:
+        tree = get_repo(repo_name).get_git_tree(sha)
+    except GithubException as e:
+        raise GithubException(f"Failed to get tree '{sha}' of repository '{repo_name}': {e.data}")
+    return tuple((entry.path, entry.type, entry.sha) for entry in tree.tree)
+
+@functools.lru_cache(maxsize=64)
+def get_tree_blob_shas(repo_name: str, sha: str) -> Mapping[str, str]:
+    """Path -> blob SHA lookup for a commit's tree, built once per commit."""
+    return types.MappingProxyType(dict(get_tree_files(repo_name, sha)))
+
+def resolve_branch_sha(repo_name: str, branch: str = "main") -> str:
+    """
+    Resolve the head commit SHA of a branch, reusing the last answer for BRANCH_HEAD_TTL seconds.
+
+    Raises:
+        ValueError: If GITHUB_ACCESS_TOKEN is not set.
+        GithubException: On repository access or API failure.
+    """
+    entry = _branch_heads.get((repo_name, branch))
+    if entry is not None and time.monotonic() - entry[0] < BRANCH_HEAD_TTL:
+        return entry[1]
+
+    sha = fetch_branch_sha(repo_name, branch)
+    if sha is None:
+        repo = get_repo(repo_name)
+        try:
+            sha = repo.get_branch(branch).commit.sha
+        except GithubException as e:
+            raise GithubException(f"Failed to get branch '{branch}' of repository '{repo_name}': {e.data}")
+
+    _branch_heads[(repo_name, branch)] = (time.monotonic(), sha)
+    return sha
+
+def fetch_branch_sha(repo_name, branch):
+    # Conditional request: while the branch has not moved GitHub answers 304 with no body, and 304s
+    # do not count against the rate limit. Returns None on any other failure so the caller can fall
+    # back to PyGithub and its error reporting.
+    token = os.getenv("GITHUB_ACCESS_TOKEN")
+    if not token:
+        return None
+    etag, sha = _branch_etags.get((repo_name, branch), (None, None))
+    headers = {"Accept": "application/vnd.github.sha", "Authorization": f"Bearer {token}"}
+    if etag:
+        headers["If-None-Match"] = etag
+    try:
+        response = http_client.get(f"{GITHUB_API_URL}/repos/{repo_name}/commits/{quote(branch)}", headers=headers)
+    except httpx.HTTPError:
+        return None
+    if response.status_code == 304 and sha:
+        return sha
+    if response.status_code != 200:
+        return None
+    sha = response.text.strip()
+    if response.headers.get("ETag"):
+        _branch_etags[(repo_name, branch)] = (response.headers["ETag"], sha)
+    return sha
+
+def get_all_github_file_entries(repo_name: str, branch: str = "main") -> List[Tuple[str, str]]:
     """
-    Recursively retrieve all file paths from a specific branch of a GitHub repository.
+    Retrieve (path, blob SHA) for every file on a specific branch of a GitHub repository.
 
     Args:
         repo_name (str): Full repository name in the format "owner/repo".
         branch (str): Branch name to retrieve files from. Defaults to "main".
 
     Returns:
-        List[str]: A list of all file paths in the specified branch of the repository.
+        List[Tuple[str, str]]: (file path, blob SHA) pairs; a file's blob SHA only changes when its content does.
 
     Raises:
         ValueError: If GITHUB_ACCESS_TOKEN is not set.
         GithubException: On repository access or API failure.
     """
-    token = os.getenv("GITHUB_ACCESS_TOKEN")
-    if not token:
-        raise ValueError("GITHUB_ACCESS_TOKEN environment variable is not set.")
+    return list(get_tree_files(repo_name, resolve_branch_sha(repo_name, branch)))
 
-    gh = Github(token)
+def get_github_files_page(repo_name: str, branch: str = "main", cursor: str = None) -> Dict[str, List[str]]:
+    """
+    List one directory of a branch: its files and its subdirectories, each of which is the cursor for a later page.
 
-    try:
-        repo = gh.get_repo(repo_name)
-    except GithubException as e:
-        raise GithubException(f"Failed to access repository '{repo_name}': {e.data}")
+    Unlike get_all_github_files this costs one non-recursive tree call per page, so the caller can start on
+    top-level files such as README.md without waiting for the whole tree of a large repository.
 
-    def get_all_file_paths(path: str = ""):
-        files = []
-        try:
-            contents = repo.get_contents(path, ref=branch)
-        except GithubException as e:
-            raise GithubException(f"Failed to get contents of path '{path}' in branch '{branch}': {e.data}")
-
-        if isinstance(contents, ContentFile):
-            files.append(contents.path)
-        else:
-            for content in contents:
-                if content.type == "dir":
-                    files.extend(get_all_file_paths(content.path))
-                else:
-                    files.append(content.path)
-        return files
-
-    return get_all_file_paths()
+    Args:
+        repo_name (str): Full repository name in the format "owner/repo".
+        branch (str): Branch name to retrieve files from. Defaults to "main".
+        cursor (str): Directory to list, as returned in "directories" by an earlier page. Defaults to the root.
+
+    Returns:
+        Dict[str, List[str]]: {"files": [...], "directories": [...]}, both as full paths from the repository root.
+
+    Raises:
+        ValueError: If GITHUB_ACCESS_TOKEN is not set.
+        GithubException: On repository access or API failure, or if the cursor is not a directory.
+    """
+    sha = resolve_branch_sha(repo_name, branch)
+    prefix = ""
+    for name in filter(None, (cursor or "").split("/")):
+        entry = next((e for e in get_tree_entries(repo_name, sha) if e[0] == name), None)
+        if entry is None or entry[1] != "tree":
+            raise GithubException(f"'{cursor}' is not a directory in branch '{branch}' of repository '{repo_name}'")
+        sha = entry[2]
+        prefix = f"{prefix}{name}/"
+
+    page = {"files": [], "directories": []}
+    for name, kind, _ in get_tree_entries(repo_name, sha):
+        path = f"{prefix}{name}"
+        if kind == "blob" and not EXCLUDE_RE.search(path):
+            page["files"].append(path)
+        elif kind == "tree" and not EXCLUDE_RE.search(f"{path}/"):
+            page["directories"].append(path)
+    return page
+
+def get_all_github_files(repo_name: str, branch: str = "main") -> List[str]:
+    """
+    Retrieve all file paths from a specific branch of a GitHub repository.
+
+    Args:
+        repo_name (str): Full repository name in the format "owner/repo".
+        branch (str): Branch name to retrieve files from. Defaults to "main".
+
+    Returns:
+        List[str]: A list of all file paths in the specified branch of the repository,
+            leaving out vendored/build directories and binary files (see EXCLUDE_RE).
+
+    Raises:
+        ValueError: If GITHUB_ACCESS_TOKEN is not set.
+        GithubException: On repository access or API failure.
+    """
+    return [path for path, _ in get_all_github_file_entries(repo_name, branch) if not EXCLUDE_RE.search(path)]
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="List all files in a GitHub repo branch.")
@@ -0,0 +1,56 @@
+import asyncio
+import importlib.util
+import logging
+import os
+try:
+    # libuv-based event loop: cheaper socket reads on the SSE streams; the stdlib loop is used without it
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger(__name__)
+
+# LangChain agents that can share one interpreter and event loop.
+# The CrewAI and CAMEL agents run their own blocking loops and are still launched separately.
+AGENT_SCRIPTS = [
+    "0-langchain-interface.py",
+    "3-langchain-UnitTestRunnerAgent.py",
+    "4-langchain-RepoUnderstandingAgent.py",
+    "5-langchain-RepoUnitTestAdvisorAgent.py",
+    "6-langchain-RepoDocConsistencyCheckerAgent.py",
+]
+
+def load_agent(script):
+    """
+    Import an agent script by path, since the numbered file names are not valid module names.
+
+    Args:
+        script (str): File name of the agent script, relative to this directory.
+
+    Returns:
+        module: The loaded agent module, exposing its `main()` coroutine.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script)
+    module_name = os.path.splitext(script)[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+async def main():
+    agents = [load_agent(script) for script in AGENT_SCRIPTS]
+    logger.info(f"Starting {len(agents)} agents in one process")
+
+    # Each agent keeps its own Coral connection (one agentId per SSE session) and retry loop;
+    # an agent that gives up does not stop the others.
+    results = await asyncio.gather(*(agent.main() for agent in agents), return_exceptions=True)
+    for script, result in zip(AGENT_SCRIPTS, results):
+        if isinstance(result, Exception):
+            logger.error(f"{script} exited with error: {result}")
+
+if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
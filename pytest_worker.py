@@ -0,0 +1,40 @@
+import json
+import os
+import sys
+import traceback
+
+import pytest
+
+# Printed after each run so the agent knows where one run's output ends
+DONE_MARKER = "@@pytest-worker-done@@"
+
+def purge_project_modules(root):
+    # Drop modules imported from the project so edited sources and tests are imported fresh on the next run
+    for name, module in list(sys.modules.items()):
+        path = getattr(module, "__file__", None) or ""
+        if path.startswith(root + os.sep):
+            del sys.modules[name]
+
+def main():
+    """
+    Long-lived pytest runner for one project, started by the unit test runner agent with cwd set to the project root.
+
+    Reads one JSON list of pytest arguments per line from stdin, runs it in-process with pytest.main(),
+    and ends each run's output with a DONE_MARKER line carrying the exit code, e.g.
+    `@@pytest-worker-done@@ {"exit_code": 1}`.
+    """
+    root = os.getcwd()
+    for line in sys.stdin:
+        args = json.loads(line)
+        purge_project_modules(root)
+        try:
+            exit_code = int(pytest.main(args))
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc(file=sys.stdout)
+            exit_code = 1
+        print(f"{DONE_MARKER} {json.dumps({'exit_code': exit_code})}", flush=True)
+
+if __name__ == "__main__":
+    main()
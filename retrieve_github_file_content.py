@@ -1,12 +1,40 @@
 import os
 import sys
 import argparse
-from github import Github, GithubException, ContentFile
+import threading
+from typing import Dict, List
+import httpx
+try:
+    # SIMD base64 decoding; same API as the standard library module
+    import pybase64 as base64
+except ImportError:
+    import base64
+from github import GithubException, ContentFile
+from get_all_github_files import GITHUB_API_URL, get_repo, get_tree_blob_shas, resolve_branch_sha
+from get_all_github_files import http_client as _http_client
+
+GRAPHQL_URL = f"{GITHUB_API_URL}/graphql"
+GRAPHQL_BATCH_SIZE = 100  # keep each query well inside GitHub's node limits
+BLOB_CACHE_SIZE = 1024
+
+# blob SHA -> decoded content. Blobs are content-addressed, so an entry never goes stale;
+# a changed file shows up under a new SHA once the branch head moves.
+_blob_cache = {}
+_blob_cache_lock = threading.Lock()
+
+def cache_blob(sha, content):
+    with _blob_cache_lock:
+        if len(_blob_cache) >= BLOB_CACHE_SIZE:
+            _blob_cache.pop(next(iter(_blob_cache)))
+        _blob_cache[sha] = content
 
 def retrieve_github_file_content(repo_name: str, file_path: str, branch: str = "main") -> str:
     """
     Retrieve the content of a specific file from a specific branch of a GitHub repository.
 
+    The file's blob SHA is looked up in the branch's cached tree listing, and content already
+    fetched for that SHA is returned without another request.
+
     Args:
         repo_name (str): Full repository name in the format "owner/repo".
         file_path (str): Path to the file in the repository.
@@ -17,27 +45,129 @@ def retrieve_github_file_content(repo_name: str, file_path: str, branch: str = "
 
     Raises:
         ValueError: If GITHUB_ACCESS_TOKEN is not set.
-        GithubException: On repository access or API failure.
-        ValueError: If multiple files are returned (e.g., by mistake).
+        GithubException: On repository access or API failure, or if the path is not a file on the branch.
+    """
+    blob_sha = get_tree_blob_shas(repo_name, resolve_branch_sha(repo_name, branch)).get(file_path)
+    if blob_sha is None:
+        raise GithubException(f"File '{file_path}' not found in branch '{branch}'; the path may refer to a directory, not a file.")
+
+    content = _blob_cache.get(blob_sha)
+    if content is None:
+        content = fetch_raw_blob(repo_name, blob_sha)
+        if content is None:
+            try:
+                blob = get_repo(repo_name).get_git_blob(blob_sha)
+            except GithubException as e:
+                raise GithubException(f"Failed to get content of file '{file_path}' in branch '{branch}': {e.data}")
+            content = base64.b64decode(blob.content, validate=False).decode()
+        cache_blob(blob_sha, content)
+    return content
+
+def fetch_raw_blob(repo_name, blob_sha):
+    # The raw media type returns the file bytes as-is, skipping the base64 JSON payload; None means "use PyGithub"
+    try:
+        response = _http_client.get(
+            f"{GITHUB_API_URL}/repos/{repo_name}/git/blobs/{blob_sha}",
+            headers={
+                "Authorization": f"Bearer {os.getenv('GITHUB_ACCESS_TOKEN')}",
+                "Accept": "application/vnd.github.raw+json"
+            }
+        )
+    except httpx.HTTPError:
+        return None
+    if response.status_code != 200:
+        return None
+    return response.content.decode()
+
+def retrieve_github_files_batch(repo_name: str, file_paths: List[str], branch: str = "main") -> Dict[str, str]:
+    """
+    Retrieve the content of several files from one branch with a single GitHub GraphQL query per 100 files.
+
+    Files whose blob SHA is already in the content cache are not queried again.
+
+    Args:
+        repo_name (str): Full repository name in the format "owner/repo".
+        file_paths (List[str]): Paths to the files in the repository.
+        branch (str): Branch name to retrieve the files from. Defaults to "main".
+
+    Returns:
+        Dict[str, str]: File path -> file content, or an "ERROR: ..." string for paths that
+            do not exist on the branch or point to a binary file or directory.
+
+    Raises:
+        ValueError: If GITHUB_ACCESS_TOKEN is not set or repo_name is not "owner/repo".
+        GithubException: If the GraphQL query fails.
     """
     token = os.getenv("GITHUB_ACCESS_TOKEN")
     if not token:
         raise ValueError("GITHUB_ACCESS_TOKEN environment variable is not set.")
+    owner, sep, name = repo_name.partition("/")
+    if not sep:
+        raise ValueError(f"Repository name '{repo_name}' must be in the format 'owner/repo'.")
 
-    gh = Github(token)
-    try:
-        repo = gh.get_repo(repo_name)
-    except GithubException as e:
-        raise GithubException(f"Failed to access repository '{repo_name}': {e.data}")
+    blob_shas = get_tree_blob_shas(repo_name, resolve_branch_sha(repo_name, branch))
+    paths = list(dict.fromkeys(file_paths))
+    contents = {}
+    missing = []
+    for path in paths:
+        blob_sha = blob_shas.get(path)
+        cached = _blob_cache.get(blob_sha)
+        if blob_sha is None:
+            contents[path] = f"ERROR: '{path}' not found in branch '{branch}' (or it is a directory)."
+        elif cached is not None:
+            contents[path] = cached
+        else:
+            missing.append(path)
 
-    try:
-        file_content = repo.get_contents(file_path, ref=branch)
-    except GithubException as e:
-        raise GithubException(f"Failed to get content of file '{file_path}' in branch '{branch}': {e.data}")
+    if missing:
+        contents.update(fetch_blobs_graphql(token, owner, name, branch, missing))
+    return {path: contents[path] for path in paths}
+
+def fetch_blobs_graphql(token, owner, name, branch, paths):
+    contents = {}
+    for start in range(0, len(paths), GRAPHQL_BATCH_SIZE):
+        batch = paths[start:start + GRAPHQL_BATCH_SIZE]
+        # Expressions go in as variables so paths never need escaping inside the query text
+        variables = {"owner": owner, "name": name}
+        declarations = ["$owner: String!", "$name: String!"]
+        fields = []
+        for i, path in enumerate(batch):
+            variables[f"e{i}"] = f"{branch}:{path}"
+            declarations.append(f"$e{i}: String!")
+            fields.append(f"f{i}: object(expression: $e{i}) {{ ... on Blob {{ oid text isBinary isTruncated }} }}")
+        query = (
+            f"query({', '.join(declarations)}) "
+            f"{{ repository(owner: $owner, name: $name) {{ {' '.join(fields)} }} }}"
+        )
+
+        try:
+            response = _http_client.post(
+                GRAPHQL_URL,
+                headers={"Authorization": f"Bearer {token}"},
+                json={"query": query, "variables": variables}
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            raise GithubException(f"GraphQL request for repository '{owner}/{name}' failed: {e}")
+        payload = response.json()
+        repository = (payload.get("data") or {}).get("repository")
+        if repository is None:
+            raise GithubException(f"Failed to access repository '{owner}/{name}': {payload.get('errors')}")
 
-    if isinstance(file_content, list):
-        raise ValueError("Multiple files returned; the path may refer to a directory, not a file.")
-    return file_content.decoded_content.decode()
+        for i, path in enumerate(batch):
+            blob = repository.get(f"f{i}")
+            if not blob:
+                contents[path] = f"ERROR: '{path}' not found in branch '{branch}' (or it is a directory)."
+            elif blob.get("isBinary") or blob.get("text") is None:
+                contents[path] = f"ERROR: '{path}' is a binary file."
+            elif blob.get("isTruncated"):
+                # GraphQL cuts off the text of large blobs; fetch the whole file over REST instead
+                # (it caches the complete content under the same blob SHA; the cut-off text is never cached)
+                contents[path] = retrieve_github_file_content(f"{owner}/{name}", path, branch)
+            else:
+                contents[path] = blob["text"]
+                cache_blob(blob["oid"], blob["text"])
+    return contents
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Retrieve GitHub file content.")